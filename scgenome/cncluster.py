@@ -1,7 +1,14 @@
 import numpy as np
+import scipy.sparse
 import scipy.spatial
 
 
+def _sparse_sum_squared_distance(X, center):
+    """ Sum of squared euclidean distances between rows of a sparse matrix and a center
+    """
+    return X.multiply(X).sum() - 2. * (X @ center).sum() + X.shape[0] * np.dot(center, center)
+
+
 def compute_bic(kmeans, X):
     """ Computes the BIC metric for a given k means clustering
 
@@ -21,9 +28,14 @@ def compute_bic(kmeans, X):
     N, d = X.shape
 
     # Compute variance for all clusters
-    cl_var = (1.0 / (N - n_clusters) / d) * sum(
-        [sum(scipy.spatial.distance.cdist(X[np.where(labels == i)], [centers[0][i]],
-                                          'euclidean') ** 2) for i in range(n_clusters)])
+    if scipy.sparse.issparse(X):
+        X = scipy.sparse.csr_matrix(X)
+        cl_var = (1.0 / (N - n_clusters) / d) * sum(
+            [_sparse_sum_squared_distance(X[np.where(labels == i)], centers[0][i]) for i in range(n_clusters)])
+    else:
+        cl_var = (1.0 / (N - n_clusters) / d) * sum(
+            [sum(scipy.spatial.distance.cdist(X[np.where(labels == i)], [centers[0][i]],
+                                              'euclidean') ** 2) for i in range(n_clusters)])
 
     const_term = 0.5 * n_clusters * np.log(N) * (d + 1)
 
@@ -4,3 +4,4 @@ from .cn_colors import cn_legend
 from .heatmap import plot_cell_cn_matrix, plot_cell_cn_matrix_fig
 from .qc import plot_gc_reads
 from .phylo import plot_tree_cn
+from .tree import plot_tree
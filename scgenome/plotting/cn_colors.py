@@ -27,25 +27,64 @@ def hex_to_rgb(h):
     return np.array(tuple(np.uint8(int(h[i:i+2], 16)) for i in (0, 2 ,4)), dtype=int)
 
 
-def map_cn_colors(X: ndarray) -> ndarray:
+def _cn_color_lut() -> ndarray:
+    """ Lookup table of colors for states offset by 1, with black at index 0 for missing states
+    """
+    max_state = max(color_reference.keys())
+    lut = np.zeros((max_state + 2, 3), dtype=np.uint8)
+    for state, hex in color_reference.items():
+        lut[state + 1] = hex_to_rgb(hex)
+    return lut
+
+
+def _map_cn_lut_idx(X: ndarray, max_state: int) -> ndarray:
+    if np.issubdtype(X.dtype, np.integer):
+        return (np.clip(X, -1, max_state) + 1).astype(np.uint8)
+
+    with np.errstate(invalid='ignore'):
+        is_valid = (X >= 0) & (np.floor(X) == X)
+    lut_idx = np.zeros(X.shape, dtype=np.uint8)
+    np.copyto(lut_idx, np.clip(X, 0, max_state) + 1, where=is_valid, casting='unsafe')
+    return lut_idx
+
+
+def map_cn_colors(X: ndarray, out: ndarray=None, chunk_size: int=1024) -> ndarray:
     """ Create an array of colors from an array of copy number states
 
+    States above the maximum state in `color_reference` are given the color of
+    the maximum state, negative, missing and non-integer states are black.
+    Rows are mapped in chunks so that temporaries are small relative to the output.
+
     Parameters
     ----------
     X : ndarray
         copy number states
+    out : ndarray, optional
+        uint8 array of shape X.shape + (3,) in which to store the colors, by default None
+    chunk_size : int, optional
+        number of rows to map at a time, by default 1024
 
     Returns
     -------
     ndarray
-        colors with shape X.shape + (3,)
+        uint8 colors with shape X.shape + (3,)
     """
-    X_colors = np.zeros(X.shape + (3,), dtype=int)
-    X_colors[X < 0, :] = 0
-    X_colors[X > max(color_reference.keys()), :] = max(color_reference.keys())
-    for state, hex in color_reference.items():
-        X_colors[X == state, :] = hex_to_rgb(hex)
-    return X_colors
+    X = np.asarray(X)
+    lut = _cn_color_lut()
+    max_state = lut.shape[0] - 2
+
+    if out is None:
+        out = np.empty(X.shape + (3,), dtype=np.uint8)
+
+    if X.ndim == 0:
+        out[...] = lut[_map_cn_lut_idx(X, max_state)]
+        return out
+
+    for start in range(0, X.shape[0], chunk_size):
+        lut_idx = _map_cn_lut_idx(X[start:start+chunk_size], max_state)
+        np.take(lut, lut_idx, axis=0, out=out[start:start+chunk_size])
+
+    return out
 
 
 def cn_legend(ax, frameon=True, loc=2, bbox_to_anchor=(0., 1.), title='Copy Number'):
@@ -3,7 +3,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
 import pandas as pd
-import Bio.Phylo
 
 from anndata import AnnData
 
@@ -11,12 +10,115 @@ from matplotlib.axes import Axes
 from matplotlib.figure import Figure
 from matplotlib.patches import Patch
 import matplotlib.cm
+import scipy.sparse
 
 import scgenome.cnplot
 import scgenome.refgenome
+import scgenome.tools.getters
+import scgenome.tools.phylo
+import scgenome.plotting.tree
 from . import cn_colors
 
 
+def _group_bounds(n, n_groups):
+    """ Start index of each of n_groups near equal size groups of n consecutive items
+    """
+    n_groups = int(min(max(n_groups, 1), n))
+    return np.unique(np.round(np.linspace(0, n, n_groups + 1)).astype(int))[:-1]
+
+
+def _downsample_bins(chrom_idxs, n_groups):
+    """ Start index of groups of consecutive bins that do not cross chromosome boundaries
+    """
+    chrom_starts = np.concatenate([[0], np.flatnonzero(chrom_idxs[1:] != chrom_idxs[:-1]) + 1, [len(chrom_idxs)]])
+    group_size = len(chrom_idxs) / n_groups
+
+    starts = []
+    for chrom_start, chrom_end in zip(chrom_starts[:-1], chrom_starts[1:]):
+        n_chrom_groups = np.round((chrom_end - chrom_start) / group_size)
+        starts.append(chrom_start + _group_bounds(chrom_end - chrom_start, n_chrom_groups))
+
+    return np.concatenate(starts)
+
+
+def _downsample_matrix(X, row_starts, col_starts, mode=False, chunk_size=1000):
+    """ Aggregate blocks of a matrix by mean or by the most frequent integer value
+    """
+    row_sizes = np.diff(np.append(row_starts, X.shape[0]))
+    col_sizes = np.diff(np.append(col_starts, X.shape[1]))
+
+    states = None
+    if mode and X.size > 0:
+        min_value, max_value = np.fmin.reduce(X, axis=None), np.fmax.reduce(X, axis=None)
+        if np.isnan(min_value):
+            states = np.array([], dtype=int)
+        elif np.ceil(max_value) - np.floor(min_value) < 256:
+            states = np.arange(int(np.floor(min_value)), int(np.ceil(max_value)) + 1)
+
+    if states is None:
+        X_sum = np.add.reduceat(np.add.reduceat(X, row_starts, axis=0, dtype=np.float64), col_starts, axis=1)
+        return X_sum / (row_sizes[:, np.newaxis] * col_sizes[np.newaxis, :])
+
+    # Count each state in each block, a chunk of row groups at a time, blocks
+    # without integer values are missing
+    if np.issubdtype(X.dtype, np.floating):
+        X_mode = np.full((len(row_starts), len(col_starts)), np.nan, dtype=X.dtype)
+    else:
+        X_mode = np.empty((len(row_starts), len(col_starts)), dtype=X.dtype)
+    for group_start in range(0, len(row_starts), chunk_size):
+        group_end = min(group_start + chunk_size, len(row_starts))
+        rows_start = row_starts[group_start]
+        rows_end = row_starts[group_end] if group_end < len(row_starts) else X.shape[0]
+        X_chunk = X[rows_start:rows_end]
+        chunk_row_starts = row_starts[group_start:group_end] - rows_start
+
+        max_counts = np.zeros((group_end - group_start, len(col_starts)), dtype=np.int64)
+        for state in states:
+            counts = np.add.reduceat(X_chunk == state, chunk_row_starts, axis=0, dtype=np.int64)
+            counts = np.add.reduceat(counts, col_starts, axis=1)
+            is_max = counts > max_counts
+            max_counts[is_max] = counts[is_max]
+            X_mode[group_start:group_end][is_max] = state
+
+    return X_mode
+
+
+def _downsample_shape(ax, downsample):
+    """ Target number of rows and columns, the size of the axes in pixels if not given
+    """
+    if downsample is True:
+        bbox = ax.get_window_extent()
+        return int(np.ceil(bbox.height)), int(np.ceil(bbox.width))
+    return downsample
+
+
+def _gather_layer(adata, layer_name, cell_ordering, genome_ordering):
+    """ Copy of one layer with cells and bins reordered in a single gather
+
+    Sparse and backed layers are read in chunks of cells and scattered into
+    the reordered dense matrix.
+    """
+    data = adata.layers[layer_name] if layer_name is not None else adata.X
+
+    if isinstance(data, np.ndarray):
+        return data[np.ix_(cell_ordering, genome_ordering)]
+
+    cell_positions = np.empty(adata.shape[0], dtype=int)
+    cell_positions[cell_ordering] = np.arange(len(cell_ordering))
+
+    X = None
+    for cells, chunk in scgenome.tools.getters.iter_layer_chunks(adata, layer_name):
+        if scipy.sparse.issparse(chunk):
+            chunk = chunk[:, genome_ordering].toarray()
+        else:
+            chunk = np.asarray(chunk)[:, genome_ordering]
+        if X is None:
+            X = np.empty((len(cell_ordering), len(genome_ordering)), dtype=chunk.dtype)
+        X[cell_positions[cells]] = chunk
+
+    return X
+
+
 def plot_cell_cn_matrix(
         adata: AnnData,
         layer_name='state',
@@ -27,7 +129,8 @@ def plot_cell_cn_matrix(
         vmin=None,
         vmax=None,
         cmap=None,
-        show_cell_ids=False):
+        show_cell_ids=False,
+        downsample=False):
     """ Plot a copy number matrix
 
     Parameters
@@ -50,6 +153,11 @@ def plot_cell_cn_matrix(
         matplotlib colormap name, only used if raw=True
     show_cell_ids : bool, optional
         show cell ids on heatmap axis, by default False
+    downsample : bool or tuple, optional
+        aggregate cells and bins to at most the given number of rows and columns,
+        or to the size of the axes in pixels if True, taking the most frequent state
+        if raw=False and the mean otherwise, by default False. Bins are aggregated
+        within chromosomes, and cells are not aggregated if show_cell_ids.
 
     Returns
     -------
@@ -66,6 +174,10 @@ def plot_cell_cn_matrix(
         adata = scgenome.datasets.OV2295_HMMCopy_reduced()
         scgenome.pl.plot_cell_cn_matrix(adata)
 
+    Plot a large matrix at the resolution of the axes
+
+    >>> scgenome.pl.plot_cell_cn_matrix(adata, downsample=True)
+
     """
 
     if ax is None:
@@ -89,29 +201,39 @@ def plot_cell_cn_matrix(
         cell_ordering = np.lexsort(cell_order_values)
 
     else:
-        cell_ordering = range(adata.shape[0])
+        cell_ordering = np.arange(adata.shape[0])
 
-    adata = adata[cell_ordering, genome_ordering]
+    X = _gather_layer(adata, layer_name, cell_ordering, genome_ordering)
 
-    if layer_name is not None:
-        X = adata.layers[layer_name].copy()
-    else:
-        X = adata.X.copy()
+    adata = adata[cell_ordering, genome_ordering]
 
-    X = np.nan_to_num(X, nan=0)
+    np.nan_to_num(X, copy=False, nan=0)
 
     if not raw and max_cn is not None:
-        X[X > max_cn] = max_cn
+        np.minimum(X, max_cn, out=X)
+
+    mat_chrom_idxs = chr_start[genome_ordering][:, 1]
+
+    # Image extent in cell units, retained if cells are aggregated
+    extent = (-0.5, X.shape[1] - 0.5, X.shape[0] - 0.5, -0.5)
+
+    if downsample:
+        n_rows, n_cols = _downsample_shape(ax, downsample)
+        row_starts = np.arange(X.shape[0]) if show_cell_ids else _group_bounds(X.shape[0], n_rows)
+        col_starts = _downsample_bins(mat_chrom_idxs, n_cols)
+        X = _downsample_matrix(X, row_starts, col_starts, mode=not raw)
+        mat_chrom_idxs = mat_chrom_idxs[col_starts]
+        extent = (-0.5, X.shape[1] - 0.5, extent[2], extent[3])
 
     if not raw:
         X_colors = cn_colors.map_cn_colors(X)
-        im = ax.imshow(X_colors, aspect='auto', interpolation='none', vmin=vmin, vmax=vmax)
+        del X
+        im = ax.imshow(X_colors, aspect='auto', interpolation='none', vmin=vmin, vmax=vmax, extent=extent)
 
     else:
         cmap = matplotlib.cm.get_cmap(cmap)
-        im = ax.imshow(X, aspect='auto', cmap=cmap, interpolation='none', vmin=vmin, vmax=vmax)
+        im = ax.imshow(X, aspect='auto', cmap=cmap, interpolation='none', vmin=vmin, vmax=vmax, extent=extent)
 
-    mat_chrom_idxs = chr_start[genome_ordering][:, 1]
     chrom_boundaries = np.array([0] + list(np.where(mat_chrom_idxs[1:] != mat_chrom_idxs[:-1])[0]) + [mat_chrom_idxs.shape[0] - 1])
     chrom_sizes = chrom_boundaries[1:] - chrom_boundaries[:-1]
     chrom_mids = chrom_boundaries[:-1] + chrom_sizes / 2
@@ -280,7 +402,8 @@ def plot_cell_cn_matrix_fig(
         cmap=None,
         max_cn=13,
         show_cell_ids=False,
-        show_subsets=False):
+        show_subsets=False,
+        downsample=False):
     """ Plot a copy number matrix
 
     Parameters
@@ -289,7 +412,7 @@ def plot_cell_cn_matrix_fig(
         copy number data
     layer_name : str, optional
         layer with copy number data to plot, None for X, by default 'state'
-    tree : Bio.Phylo.BaseTree.Tree, optional
+    tree : Bio.Phylo.BaseTree.Tree or scgenome.tl.ArrayTree, optional
         phylogenetic tree
     cell_order_fields : list, optional
         columns of obs on which to sort cells, by default None
@@ -309,6 +432,10 @@ def plot_cell_cn_matrix_fig(
         show cell ids on heatmap axis, by default False
     show_subsets : bool, optional
         show subset/superset categoricals to allow identification of cell sets
+    downsample : bool or tuple, optional
+        aggregate the heatmap to the given number of rows and columns, or to the
+        resolution of the heatmap axes if True, see `plot_cell_cn_matrix`, also
+        collapses tree clades below that resolution, by default False
 
     Returns
     -------
@@ -347,16 +474,15 @@ def plot_cell_cn_matrix_fig(
         if cell_order_fields is not None and len(cell_order_fields) > 0:
             raise ValueError('cannot provide cell_order_fields and tree')
 
+        if not isinstance(tree, scgenome.tools.phylo.ArrayTree):
+            tree = scgenome.tools.phylo.ArrayTree.from_biophylo(tree)
+
         # Add phylogenetic ordering to anndata obs
-        cell_ids = []
-        for a in tree.get_terminals():
-            cell_ids.append(a.name)
+        phylo_order = tree.get_phylo_order(adata.obs.index)
 
-        assert set(cell_ids) == set(adata.obs.index), 'tree and adata have different cells'
+        assert (phylo_order >= 0).all() and len(phylo_order) == len(tree.leaf_order), 'tree and adata have different cells'
 
-        adata.obs['phylo_order'] = -1
-        for idx, _ in adata.obs.iterrows():
-            adata.obs.loc[idx, 'phylo_order'] = cell_ids.index(idx)
+        adata.obs['phylo_order'] = phylo_order
 
         cell_order_fields = ['phylo_order']
         num_phylo = 1
@@ -419,8 +545,8 @@ def plot_cell_cn_matrix_fig(
         tree_ax.spines['right'].set_visible(False)
         tree_ax.spines['bottom'].set_visible(True)
         tree_ax.spines['left'].set_visible(False)
-        with plt.rc_context({'lines.linewidth': 0.5}):
-            Bio.Phylo.draw(tree, label_func=lambda a: '', axes=tree_ax, do_show=False)
+        collapse_tree = downsample[0] if isinstance(downsample, tuple) else downsample
+        scgenome.plotting.tree.plot_tree(tree, ax=tree_ax, collapse=collapse_tree, linewidth=0.5)
         tree_ax.tick_params(axis='x', labelsize=6)
         tree_ax.set_xlabel('branch length', fontsize=8)
         tree_ax.set_ylabel('')
@@ -432,7 +558,7 @@ def plot_cell_cn_matrix_fig(
         adata, layer_name=layer_name,
         cell_order_fields=cell_order_fields,
         ax=heatmap_ax, raw=raw, vmin=vmin, vmax=vmax, cmap=cmap,
-        max_cn=max_cn, show_cell_ids=show_cell_ids)
+        max_cn=max_cn, show_cell_ids=show_cell_ids, downsample=downsample)
 
     adata = g['adata']
     im = g['im']
@@ -1,4 +1,3 @@
-import Bio.Phylo
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
@@ -6,6 +5,8 @@ from matplotlib import gridspec
 import seaborn as sns
 
 import scgenome.plotting.heatmap
+import scgenome.tools.phylo
+import scgenome.plotting.tree
 
 
 def map_annotations_to_colors(annotation, cmap):
@@ -32,12 +33,13 @@ def plot_tree_cn(
         var_label=None,
         fig=None,
         raw=False,
-        max_cn=13):
+        max_cn=13,
+        collapse_tree=False):
     """ Plot a tree aligned to a CN values matrix heatmap
 
     Parameters
     ----------
-    tree : Bio.Phylo.BaseTree.Tree
+    tree : Bio.Phylo.BaseTree.Tree or scgenome.tl.ArrayTree
         phylogenetic tree
     adata : AnnData
         Copy number data, either genes or segments
@@ -57,19 +59,22 @@ def plot_tree_cn(
         raw plotting, no integer color map, by default False
     max_cn : int, optional
         clip cn at max value, by default 13
+    collapse_tree : bool or int, optional
+        draw clades below the resolution of the tree axes as a single line, see `plot_tree`, by default False
     """    
     
     if fig is None:
         fig = plt.figure(figsize=(16, 12), dpi=150)
 
+    if not isinstance(tree, scgenome.tools.phylo.ArrayTree):
+        tree = scgenome.tools.phylo.ArrayTree.from_biophylo(tree)
+
     # Add phylogenetic ordering to anndata obs
-    cell_ids = []
-    for a in tree.get_terminals():
-        cell_ids.append(a.name)
+    phylo_order = tree.get_phylo_order(adata.obs.index)
+    if (phylo_order < 0).any():
+        raise ValueError('cells of adata missing from tree')
 
-    adata.obs['phylo_order'] = None
-    for idx, _ in adata.obs.iterrows():
-        adata.obs.loc[idx, 'phylo_order'] = cell_ids.index(idx)
+    adata.obs['phylo_order'] = phylo_order
 
     gs = gridspec.GridSpec(1, 3, width_ratios=(0.4, 0.58, 0.02))
 
@@ -80,7 +85,7 @@ def plot_tree_cn(
     ax.spines['bottom'].set_visible(True)
     ax.spines['left'].set_visible(False)
     ax.get_yaxis().set_ticks([])
-    Bio.Phylo.draw(tree, label_func=lambda a: '', axes=ax, do_show=False)
+    scgenome.plotting.tree.plot_tree(tree, ax=ax, collapse=collapse_tree)
 
     # Plot copy number heatmap
     ax = fig.add_subplot(gs[0, 1])
@@ -0,0 +1,71 @@
+import matplotlib.pyplot as plt
+import numpy as np
+
+from matplotlib.collections import LineCollection
+
+import scgenome.tools.phylo
+
+
+def plot_tree(
+        tree,
+        ax=None,
+        collapse=False,
+        linewidth=0.5,
+        color='k'):
+    """ Plot a phylogenetic tree as a single line collection
+
+    Branch coordinates are computed for all nodes at once and drawn as one
+    artist, rather than one artist per branch as in `Bio.Phylo.draw`.  Leaves
+    are drawn at y positions 0 to n-1 in tree order from the top of the axes,
+    aligned to the rows of a heatmap of cells in tree order.
+
+    Parameters
+    ----------
+    tree : Bio.Phylo.BaseTree.Tree or scgenome.tl.ArrayTree
+        phylogenetic tree
+    ax : matplotlib.axes.Axes, optional
+        existing axis to plot into, by default None
+    collapse : bool or int, optional
+        draw clades spanning less than one pixel, or less than one of the given
+        number of rows, as a single line, by default False
+    linewidth : float, optional
+        width of branch lines, by default 0.5
+    color : str, optional
+        color of branch lines, by default 'k'
+
+    Returns
+    -------
+    matplotlib.collections.LineCollection
+        branch lines of the tree
+
+    Examples
+    -------
+
+    >>> tree, adata = scgenome.tl.align_cn_tree(tree, adata)
+    >>> scgenome.pl.plot_tree(tree, collapse=True)
+
+    """
+    if ax is None:
+        ax = plt.gca()
+
+    if not isinstance(tree, scgenome.tools.phylo.ArrayTree):
+        tree = scgenome.tools.phylo.ArrayTree.from_biophylo(tree)
+
+    n_leaves = len(tree.leaf_order)
+
+    min_clade_size = None
+    if collapse is True:
+        collapse = int(np.ceil(ax.get_window_extent().height))
+    if collapse:
+        min_clade_size = n_leaves / collapse
+
+    segments = tree.segments(min_clade_size=min_clade_size)
+
+    lines = LineCollection(segments, linewidths=linewidth, colors=color)
+    ax.add_collection(lines)
+
+    max_x = segments[:, :, 0].max() if len(segments) > 0 else 1.
+    ax.set_xlim(-0.02 * max_x, 1.02 * max_x)
+    ax.set_ylim(n_leaves - 0.5, -0.5)
+
+    return lines
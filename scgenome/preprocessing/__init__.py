@@ -2,3 +2,4 @@
 from .filtering import filter_cells, calculate_filter_metrics
 from .load_cn import create_cn_anndata, read_dlp_hmmcopy, convert_dlp_hmmcopy, convert_dlp_signals, read_bam_bin_counts, read_medicc2_cn
 from .load_snv import read_snv_genotyping
+from .dtype_policy import apply_dtype_policy
@@ -0,0 +1,165 @@
+import logging
+import numpy as np
+import scipy.sparse
+
+from anndata import AnnData
+from typing import Dict, Union
+
+
+compact_dtypes = {
+    # Integer copy number states
+    'state': np.int8,
+    'cn_a': np.int8,
+    'cn_b': np.int8,
+    'state_a': np.int8,
+    'state_b': np.int8,
+    'Maj': np.int8,
+    'Min': np.int8,
+
+    # Binary gain / loss indicators
+    'is_gain': np.bool_,
+    'is_loss': np.bool_,
+
+    # Continuous copy number
+    'copy': np.float32,
+    'BAF': np.float32,
+
+    # Read counts
+    'reads': np.int32,
+    'totalcounts': np.int32,
+    'alleleA': np.int32,
+    'alleleB': np.int32,
+    'alt_count': np.int32,
+    'ref_count': np.int32,
+}
+
+
+def _fits_dtype(values, dtype) -> bool:
+    """ Check whether values can be losslessly represented by an integer or bool dtype.
+    """
+    if values.size == 0:
+        return True
+
+    if not np.isfinite(values).all():
+        return False
+
+    if np.issubdtype(values.dtype, np.integer):
+        integral = True
+    else:
+        integral = np.array_equal(values, np.round(values))
+
+    if not integral:
+        return False
+
+    if dtype == np.bool_:
+        return np.isin(values, (0, 1)).all()
+
+    info = np.iinfo(dtype)
+    return values.min() >= info.min and values.max() <= info.max
+
+
+def _compact_array(data, dtype, name=None):
+    """ Convert an array to a compact dtype.
+
+    Integer and bool dtypes are only used if the data has no missing values
+    and can be represented without loss, otherwise fall back to float32, which
+    retains nan for missing entries, and log a warning.
+    """
+    if not scipy.sparse.issparse(data):
+        data = np.asarray(data)
+
+    if data.dtype == object:
+        data = data.astype(np.float32)
+
+    if dtype is None:
+        # Generic downcasting for data without a specified dtype
+        if np.issubdtype(data.dtype, np.floating):
+            dtype = np.float32
+        elif np.issubdtype(data.dtype, np.integer):
+            dtype = np.int32
+        else:
+            return data
+
+    dtype = np.dtype(dtype).type
+
+    if dtype == np.bool_ or np.issubdtype(dtype, np.integer):
+        values = data.data if scipy.sparse.issparse(data) else data
+        if not _fits_dtype(values, dtype):
+            if np.issubdtype(values.dtype, np.floating) and np.isnan(values).any():
+                reason = 'missing values'
+            else:
+                reason = 'values not representable'
+            logging.warning(f'{name or "data"} cannot be stored as {np.dtype(dtype).name}, {reason}, using float32')
+            dtype = np.float32
+
+    if data.dtype == dtype:
+        return data
+
+    return data.astype(dtype)
+
+
+def apply_dtype_policy(
+        adata: AnnData,
+        dtype_policy: Union[None, str, Dict]='compact',
+        X_name: str=None,
+    ) -> AnnData:
+    """ Convert X and layers to compact dtypes inplace.
+
+    States are stored as int8, gain / loss indicators as bool, continuous copy
+    number as float32 and read counts as int32.  Integer and bool dtypes are
+    only used if the data has no missing values and is representable without
+    loss, otherwise float32 is used and missing values remain nan, and a
+    warning is logged.  Integer dtypes have no missing value, so state layers
+    with missing bins, as is common for HMMCopy state, are stored as float32.
+
+    Parameters
+    ----------
+    adata : AnnData
+        data to convert
+    dtype_policy : str or dict, optional
+        'compact' for the default compact dtypes, a dict of dtypes keyed by layer
+        name with None for X, or None for no conversion, by default 'compact'
+    X_name : str, optional
+        name of the quantity stored in X, used to look up the X dtype in the
+        compact dtypes, by default None
+
+    Returns
+    -------
+    AnnData
+        data with compact dtypes
+
+    Examples
+    -------
+
+    >>> import scgenome
+    >>> import anndata as ad
+    >>> import numpy as np
+    >>> adata = ad.AnnData(np.array([[10., 20.], [30., 40.]]), layers={'state': np.array([[2., 3.], [2., 2.]])})
+    >>> adata = scgenome.pp.apply_dtype_policy(adata, X_name='reads')
+    >>> adata.X.dtype, adata.layers['state'].dtype
+    (dtype('int32'), dtype('int8'))
+
+    """
+    if dtype_policy is None:
+        return adata
+
+    if dtype_policy == 'compact':
+        layer_dtypes = dict(compact_dtypes)
+        layer_dtypes[None] = compact_dtypes.get(X_name)
+        for layer_name in adata.layers.keys():
+            layer_dtypes.setdefault(layer_name, None)
+
+    elif isinstance(dtype_policy, dict):
+        layer_dtypes = dtype_policy
+
+    else:
+        raise ValueError(f'unrecognized dtype_policy {dtype_policy}')
+
+    if adata.X is not None and None in layer_dtypes:
+        adata.X = _compact_array(adata.X, layer_dtypes[None], name='X')
+
+    for layer_name in list(adata.layers.keys()):
+        if layer_name in layer_dtypes:
+            adata.layers[layer_name] = _compact_array(adata.layers[layer_name], layer_dtypes[layer_name], name=f'layer {layer_name}')
+
+    return adata
@@ -1,9 +1,13 @@
 import logging
 import numpy as np
+import pandas as pd
+import scipy.sparse
 import scipy.stats
 
 from anndata import AnnData
 
+import scgenome.tools.getters
+
 
 
 _default_filters = (
@@ -13,12 +17,48 @@ _default_filters = (
     'filter_is_s_phase',
 )
 
+def _copy_state_diff_mean_chunked(adata: AnnData, chunk_size: int) -> np.ndarray:
+    if chunk_size is None:
+        chunk_size = scgenome.tools.getters.default_chunk_size
+
+    copy_state_diff_mean = []
+    for (_, copy), (_, state) in zip(
+            scgenome.tools.getters.iter_layer_chunks(adata, 'copy', chunk_size=chunk_size),
+            scgenome.tools.getters.iter_layer_chunks(adata, 'state', chunk_size=chunk_size)):
+        if scipy.sparse.issparse(copy):
+            copy = copy.toarray()
+        if scipy.sparse.issparse(state):
+            state = state.toarray()
+        copy_state_diff_mean.append(np.nanmean(np.absolute(copy - state), axis=1))
+
+    return np.concatenate(copy_state_diff_mean)
+
+
+def _shallow_copy(adata: AnnData) -> AnnData:
+    """ Copy an AnnData with new obs, sharing X, layers and other data.
+    """
+    return AnnData(
+        X=adata.X,
+        obs=adata.obs.copy(),
+        var=adata.var,
+        uns=dict(adata.uns),
+        obsm=dict(adata.obsm),
+        varm=dict(adata.varm),
+        obsp=dict(adata.obsp),
+        varp=dict(adata.varp),
+        layers=dict(adata.layers),
+    )
+
+
 def calculate_filter_metrics(
         adata: AnnData,
         quality_score_threshold=0.75,
         read_count_threshold=500000,
         copy_state_diff_threshold=1.,
         inplace = False,
+        chunk_size = None,
+        store_diff = True,
+        return_obs = False,
     ) -> AnnData:
     """ Calculate additional filtering metrics to be used by other filtering methods.
 
@@ -33,12 +73,22 @@ def calculate_filter_metrics(
     copy_state_diff_threshold : [type], optional
         Minimum copy-state difference threshold to set to keep, by default 1.
     inplace : bool, optional
-        Whether to modify passed in AnnData, by default False
+        Whether to modify passed in AnnData, by default False, return a copy
+        of AnnData with new obs, sharing X and layers with the passed in AnnData
+    chunk_size : int, optional
+        Number of cells for which to compute copy-state difference at a time, by default None
+    store_diff : bool, optional
+        Store the per bin copy-state difference matrix in obsm, by default True.  The
+        matrix is not stored if chunk_size is given, for backed AnnData or if return_obs,
+        and the copy-state difference mean is computed in chunks of cells without
+        allocating the full matrix.  Set to False to stream in-memory AnnData.
+    return_obs : bool, optional
+        Return only the new obs columns and leave AnnData unmodified, by default False
 
     Returns
     -------
-    AnnData
-        AnnData with modified obs if not inplace, otherise, None
+    AnnData or DataFrame
+        AnnData with modified obs, or the new obs columns if return_obs
 
     Note
     ----
@@ -51,46 +101,85 @@ def calculate_filter_metrics(
     If is_s_phase is a property of AnnData
         AnnData.obs.filter_is_s_phase
         
-    AnnData.obs.copy_state_diff
     AnnData.obs.copy_state_diff_mean
+    AnnData.obsm.copy_state_diff_mean, deprecated, use AnnData.obs.copy_state_diff_mean
+
+    If store_diff, and chunk_size is None and AnnData is not backed
+        AnnData.obsm.copy_state_diff
+
+    Backed AnnData is not copied, use inplace or return_obs.
     """
-    if not inplace:
-        ndad = adata.copy()
-        
-        return calculate_filter_metrics(
-            ndad,
-            quality_score_threshold,
-            read_count_threshold,
-            copy_state_diff_threshold,
-            inplace = True,
-        )
+    if adata.isbacked and not (inplace or return_obs):
+        raise ValueError('cannot copy backed AnnData, use inplace=True or return_obs=True')
+
+    metrics = pd.DataFrame(index=adata.obs.index)
 
     # Filter Quality and Filter Reads
     if 'quality' in adata.obs.columns:
-        adata.obs['filter_quality'] = (adata.obs['quality'] > quality_score_threshold)
+        metrics['filter_quality'] = (adata.obs['quality'] > quality_score_threshold)
     else:
         logging.warning("quality is not in AnnData.obs. Skipping filter_quality")
     
     if 'total_mapped_reads_hmmcopy' in adata.obs.columns:
-        adata.obs['filter_reads'] = (adata.obs['total_mapped_reads_hmmcopy'] > read_count_threshold)
+        metrics['filter_reads'] = (adata.obs['total_mapped_reads_hmmcopy'] > read_count_threshold)
     else:
         logging.warning("total_mapped_reads_hmmcopy is not in AnnData.obs. Skipping total_mapped_reads_hmmcopy")
     
     # Copy State Difference Filter
-    adata.obsm['copy_state_diff'] = np.absolute(adata.layers['copy'] - adata.layers['state'])
-    adata.obsm['copy_state_diff_mean'] = np.nanmean(adata.obsm['copy_state_diff'], axis=1)
+    copy_state_diff = None
+    if store_diff and chunk_size is None and not adata.isbacked and not return_obs:
+        copy_state_diff = np.absolute(adata.layers['copy'] - adata.layers['state'])
+        if scipy.sparse.issparse(copy_state_diff):
+            copy_state_diff = copy_state_diff.toarray()
+        metrics['copy_state_diff_mean'] = np.nanmean(copy_state_diff, axis=1)
+
+    else:
+        metrics['copy_state_diff_mean'] = _copy_state_diff_mean_chunked(adata, chunk_size)
 
-    adata.obs['filter_copy_state_diff'] = (adata.obsm['copy_state_diff_mean'] < copy_state_diff_threshold)
+    metrics['filter_copy_state_diff'] = (metrics['copy_state_diff_mean'] < copy_state_diff_threshold)
 
     # Filter s phase column
     if 'is_s_phase' in adata.obs.columns:
-        adata.obs['filter_is_s_phase'] = ~(adata.obs['is_s_phase'].fillna(False))
+        metrics['filter_is_s_phase'] = ~(adata.obs['is_s_phase'].fillna(False))
     else:
         logging.warning("No is_s_phase in AnnData.obs. Skipping filter_is_s_phase")
 
+    if return_obs:
+        return metrics
+
+    if not inplace:
+        adata = _shallow_copy(adata)
+
+    for col in metrics.columns:
+        adata.obs[col] = metrics[col]
+
+    # Previous location of copy_state_diff_mean, retained for compatibility
+    adata.obsm['copy_state_diff_mean'] = metrics['copy_state_diff_mean'].values
+
+    if copy_state_diff is not None:
+        adata.obsm['copy_state_diff'] = copy_state_diff
+
     return adata
 
 
+def _evaluate_filter(obs: pd.DataFrame, filter_option) -> pd.Series:
+    """ Evaluate a filter column, obs expression or callable to a boolean mask.
+    """
+    if callable(filter_option):
+        mask = filter_option(obs)
+    elif filter_option in obs.columns:
+        mask = obs[filter_option]
+    else:
+        mask = obs.eval(filter_option)
+
+    mask = np.asarray(mask)
+    if mask.shape != (obs.shape[0],):
+        raise ValueError(f'filter {filter_option} does not produce one value per cell')
+
+    # Missing values do not pass filters
+    return pd.Series(mask, index=obs.index).fillna(False).astype(bool).values
+
+
 def filter_cells(
         adata: AnnData,
         filters = _default_filters,
@@ -99,41 +188,75 @@ def filter_cells(
     """
     Filter poor quality cells based on the filters provided.
 
+    All filters are combined into a single mask and the AnnData is subset once.
+    The number of cells passing each filter is logged and stored in
+    `uns['filter_cells']`.
+
     Parameters
     -------
     adata : AnnData
         AnnData to preform operation with
     filters : list, optional
-        Filters to apply. Keeps cells where filters are true, by default _default_filters
+        Filters to apply. Keeps cells where filters are true, by default _default_filters.
+        Each filter is either a boolean obs column, an expression on obs columns such
+        as 'quality > 0.9', or a callable taking obs and returning a boolean mask.
     inplace
-        Whether to modify passed in AnnData. If False, returns new AnnData.
+        If True, store the filter summary in the passed in AnnData and return a view
+        of the cells passing filters without copying data.  The cells of the passed
+        in AnnData are not modified.  If False, returns new AnnData.
 
     Returns
     -------
     AnnData
-        filtered copy number data
+        filtered copy number data, a view if inplace
+
+    Examples
+    -------
+
+    >>> adata = scgenome.pp.filter_cells(adata, filters=['filter_reads', 'quality > 0.9'])
+
     """
+    if isinstance(filters, str) or callable(filters):
+        filters = [filters]
 
-    if not inplace:
-        adata = adata.copy()
-        
-        return filter_cells(
-            adata,
-            filters,
-            inplace = True,
-        )
+    keep = np.ones(adata.shape[0], dtype=bool)
+    filter_names = []
+    n_pass = []
 
-    # Ensure cnfilter.calculate_filter_metrics has been called
     for filter_option in filters:
-        if filter_option not in adata.obs.columns:
+        filter_name = getattr(filter_option, '__name__', str(filter_option))
+
+        try:
+            mask = _evaluate_filter(adata.obs, filter_option)
+
+        # Ensure cnfilter.calculate_filter_metrics has been called
+        except (KeyError, NameError):
             logging.warning(
-                f"WARNING: {filter_option} is not found! "
+                f"WARNING: {filter_name} is not found! "
                 "Skipping. Are you sure `scgenome.pp.calculate_filter_metrics` has been called?"
             )
             continue
 
-        adata = adata[adata.obs[filter_option]]
+        logging.info(f'{mask.sum()} of {adata.shape[0]} cells pass filter {filter_name}')
 
-    return adata
+        filter_names.append(filter_name)
+        n_pass.append(int(mask.sum()))
+        keep &= mask
+
+    logging.info(f'{keep.sum()} of {adata.shape[0]} cells pass all filters')
+
+    filter_info = dict(
+        filters=filter_names,
+        n_pass=n_pass,
+        n_cells=adata.shape[0],
+        n_kept=int(keep.sum()),
+    )
 
+    if inplace:
+        adata.uns['filter_cells'] = filter_info
+        return adata[keep]
 
+    adata = adata[keep].copy()
+    adata.uns['filter_cells'] = filter_info
+
+    return adata
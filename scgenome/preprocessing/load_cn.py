@@ -11,6 +11,8 @@ from pyranges import PyRanges
 from typing import Dict, Sequence
 from pandas import DataFrame
 
+from .dtype_policy import apply_dtype_policy
+
 
 def read_dlp_hmmcopy(alignment_results_dir, hmmcopy_results_dir, annotation_results_dir, sample_ids=None, additional_hmmcopy_reads_cols=None) -> AnnData:
     """ Read hmmcopy results from the DLP pipeline.
@@ -95,6 +97,7 @@ def create_cn_anndata(
         layers_columns: Sequence[str],
         cell_metrics_data: DataFrame=None,
         bin_metrics_data: DataFrame=None,
+        dtype_policy=None,
     ) -> AnnData:
     """ Convert hmmcopy pandas dataframes to anndata
 
@@ -110,6 +113,8 @@ def create_cn_anndata(
         per cell metrics data, by default None
     bin_metrics_data : DataFrame, optional
         per bin metrics data, by default None
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
 
     Returns
     -------
@@ -181,10 +186,12 @@ def create_cn_anndata(
         layers=layers,
     )
 
+    adata = apply_dtype_policy(adata, dtype_policy, X_name=X_column)
+
     return adata
 
 
-def convert_dlp_hmmcopy(metrics_data: DataFrame, cn_data: DataFrame) -> AnnData:
+def convert_dlp_hmmcopy(metrics_data: DataFrame, cn_data: DataFrame, dtype_policy=None) -> AnnData:
     """ Convert hmmcopy pandas dataframes to anndata
 
     Parameters
@@ -193,6 +200,8 @@ def convert_dlp_hmmcopy(metrics_data: DataFrame, cn_data: DataFrame) -> AnnData:
         hmmcopy metrics
     cn_data : DataFrame
         hmmcopy reads data
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
 
     Returns
     -------
@@ -206,16 +215,19 @@ def convert_dlp_hmmcopy(metrics_data: DataFrame, cn_data: DataFrame) -> AnnData:
         layers_columns = ['copy', 'state'],
         X_column = 'reads',
         cell_metrics_data=metrics_data,
-        bin_metrics_data=cn_data[['chr', 'start', 'end', 'gc']].drop_duplicates(subset=['chr', 'start', 'end']))
+        bin_metrics_data=cn_data[['chr', 'start', 'end', 'gc']].drop_duplicates(subset=['chr', 'start', 'end']),
+        dtype_policy=dtype_policy)
 
 
-def convert_dlp_signals(hscn: DataFrame, metrics_data: DataFrame) -> AnnData:
+def convert_dlp_signals(hscn: DataFrame, metrics_data: DataFrame, dtype_policy=None) -> AnnData:
     """ Convert signals pandas dataframes to anndata
 
     Parameters
     ----------
     hscn : DataFrame
         signals reads data
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
 
     Returns
     -------
@@ -237,6 +249,7 @@ def convert_dlp_signals(hscn: DataFrame, metrics_data: DataFrame) -> AnnData:
         layers_columns=layers_columns,
         X_column='totalcounts',
         cell_metrics_data=metrics_data,
+        dtype_policy=dtype_policy,
     )
 
 
@@ -256,7 +269,7 @@ def _add_bin_index(df):
     return df.set_index('bin')
     
 
-def read_bam_bin_counts(bins: PyRanges, bams: Dict[str, str], excluded: PyRanges = None, **kwargs) -> AnnData:
+def read_bam_bin_counts(bins: PyRanges, bams: Dict[str, str], excluded: PyRanges = None, dtype_policy=None, **kwargs) -> AnnData:
     """ Count reads in bins from bams
 
     Parameters
@@ -267,6 +280,8 @@ def read_bam_bin_counts(bins: PyRanges, bams: Dict[str, str], excluded: PyRanges
         bam filenames with cell ids as keys
     excluded: PyRanges
         excluded genomic regions to filter reads
+    dtype_policy : str or dict, optional
+        dtypes of X, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
 
     Returns
     -------
@@ -308,10 +323,12 @@ def read_bam_bin_counts(bins: PyRanges, bams: Dict[str, str], excluded: PyRanges
         var=bin_data,
     )
 
+    adata = apply_dtype_policy(adata, dtype_policy, X_name='reads')
+
     return adata
 
 
-def read_medicc2_cn(cn_profiles_filename, allele_specific: bool = False) -> AnnData:
+def read_medicc2_cn(cn_profiles_filename, allele_specific: bool = False, dtype_policy=None) -> AnnData:
     """ Read medicc2 results
 
     Parameters
@@ -320,6 +337,8 @@ def read_medicc2_cn(cn_profiles_filename, allele_specific: bool = False) -> AnnD
         Copy number profiles filename
     allele_specific : bool, optional
         _description_, by default False
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
 
     Returns
     -------
@@ -405,4 +424,6 @@ def read_medicc2_cn(cn_profiles_filename, allele_specific: bool = False) -> AnnD
         layers=layers,
     )
 
+    adata = apply_dtype_policy(adata, dtype_policy, X_name='state')
+
     return adata
@@ -1,35 +1,113 @@
 import numpy as np
+import scipy.sparse
 
 from numpy import ndarray
+from scipy.sparse import spmatrix
+from typing import Union
 
 
-def fill_missing(data: ndarray) -> ndarray:
+# Number of bins filled at a time by fill_missing
+default_bin_chunk_size = 1024
+
+
+def _fill_missing_sparse(data: spmatrix, inplace: bool=False) -> spmatrix:
+    """ Fill explicitly stored nan entries of a sparse matrix with bin means.
+
+    Implicit zeros are treated as observed zero values.
+    """
+    if not (inplace and scipy.sparse.isspmatrix_csr(data)):
+        data = scipy.sparse.csr_matrix(data, copy=True)
+
+    is_nan = np.isnan(data.data)
+    if not is_nan.any():
+        return data
+
+    cols = data.indices
+
+    # Mean of each bin, ignoring nan, including implicit zeros
+    n_missing = np.bincount(cols[is_nan], minlength=data.shape[1])
+    n_present = data.shape[0] - n_missing
+    bin_sums = np.bincount(cols[~is_nan], weights=data.data[~is_nan], minlength=data.shape[1])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bin_means = bin_sums / n_present
+
+    # Set bins with nan across all cells to 0
+    bin_means[n_present == 0] = 0
+
+    data.data[is_nan] = bin_means[cols[is_nan]]
+    data.eliminate_zeros()
+
+    return data
+
+
+def fill_missing(
+        data: Union[ndarray, spmatrix],
+        inplace: bool=False,
+        out: ndarray=None,
+        chunk_size: int=None,
+    ) -> Union[ndarray, spmatrix]:
     """ Fill missing values with means of non-nan values across rows.
 
     Deal with missing values by assigning the mean value
-    of each bin to missing values of that bin
+    of each bin to missing values of that bin.  Bins are filled
+    in chunks, so no temporaries of the size of the full matrix
+    are allocated, and the dtype of the data is retained.
+
+    Sparse matrices are filled without densifying, in which case only
+    explicitly stored nan entries are missing, implicit zeros are
+    observed values.
 
     Parameters
     ----------
-    data : ndarray
+    data : ndarray or sparse matrix
         data to fill
+    inplace : bool, optional
+        fill missing entries of data inplace, by default False
+    out : ndarray, optional
+        array of the same shape as data in which to store the result, by default None
+    chunk_size : int, optional
+        number of bins to fill at a time, by default None, `default_bin_chunk_size`
 
     Returns
     -------
-    ndarray
-        copy of data with missing entries filled 
-    """    
+    ndarray or sparse matrix
+        data with missing entries filled, a copy unless inplace or out is given
+    """
 
-    data = data.copy()
+    if scipy.sparse.issparse(data):
+        return _fill_missing_sparse(data, inplace=inplace)
 
-    # Set bins with nan across all cells to 0
-    data[:, np.all(np.isnan(data), axis=0)] = 0
+    data = np.asarray(data)
 
-    # Mean of each bin, ignoring nan
-    bin_means = np.nanmean(data, axis=0)
-    bin_means = np.nan_to_num(bin_means, nan=0)
-    bin_means = np.tile(bin_means, (data.shape[0], 1))
-    data[np.where(np.isnan(data))] = bin_means[np.where(np.isnan(data))]
+    if inplace:
+        out = data
 
-    return data
+    elif out is None:
+        out = np.empty_like(data)
+
+    if chunk_size is None:
+        chunk_size = default_bin_chunk_size
+
+    for start in range(0, data.shape[1], chunk_size):
+        chunk = data[:, start:start+chunk_size]
+        out_chunk = out[:, start:start+chunk_size]
+
+        if out is not data:
+            out_chunk[:] = chunk
+
+        is_nan = np.isnan(chunk)
+        if not is_nan.any():
+            continue
+
+        # Mean of each bin, ignoring nan
+        n_present = data.shape[0] - is_nan.sum(axis=0)
+        bin_sums = np.sum(chunk, axis=0, where=~is_nan, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bin_means = bin_sums / n_present
+
+        # Set bins with nan across all cells to 0
+        bin_means[n_present == 0] = 0
+
+        np.copyto(out_chunk, bin_means.astype(out.dtype), where=is_nan)
 
+    return out
@@ -0,0 +1,153 @@
+import anndata as ad
+import numpy as np
+import pandas as pd
+
+from scgenome.tools.cntransitions import cn_transition_indices, cn_transition_regions, TransitionIndex
+
+
+def _example_adata():
+    """ 3 cells, 4 bins on chromosome 1 and 3 bins on chromosome 2, all 100bp.
+
+    cell c0: one gain on chromosome 1
+    cell c1: missing bin, loss on chromosome 1, loss on chromosome 2
+    cell c2: gain at the end of chromosome 1, change across the chromosome
+        boundary that is not a transition
+    """
+    var = pd.DataFrame({
+        'chr': ['1', '1', '1', '1', '2', '2', '2'],
+        'start': [1, 101, 201, 301, 1, 101, 201],
+    })
+    var['end'] = var['start'] + 99
+    var.index = var['chr'] + ':' + var['start'].astype(str)
+
+    state = np.array([
+        [2, 2, 3, 3, 1, 1, 1],
+        [2, np.nan, 3, 1, 4, 2, 2],
+        [1, 1, 1, 5, 0, 0, 0],
+    ])
+
+    obs = pd.DataFrame(index=['c0', 'c1', 'c2'])
+
+    return ad.AnnData(np.zeros(state.shape), obs=obs, var=var, layers={'state': state})
+
+
+def test_cn_transition_indices():
+    adata = _example_adata()
+
+    for chunk_size in (None, 1, 2):
+        cell_idx, bin_idx, state_diff = cn_transition_indices(adata, chunk_size=chunk_size)
+
+        assert cell_idx.tolist() == [0, 1, 1, 2]
+        assert bin_idx.tolist() == [2, 3, 5, 3]
+        assert state_diff.tolist() == [1, -2, -2, 4]
+
+
+def test_cn_transition_indices_unsorted_bins():
+    adata = _example_adata()
+    permutation = np.array([5, 0, 3, 6, 1, 4, 2])
+    adata = adata[:, permutation].copy()
+
+    cell_idx, bin_idx, state_diff = cn_transition_indices(adata)
+
+    transitions = set(zip(cell_idx.tolist(), adata.var.index[bin_idx], state_diff.tolist()))
+    assert transitions == {(0, '1:201', 1), (1, '1:301', -2), (1, '2:101', -2), (2, '1:301', 4)}
+
+
+def test_cn_transition_indices_dtypes():
+    adata = _example_adata()
+
+    # Losses of unsigned states are negative
+    adata.layers['state'] = np.array([
+        [2, 2, 3, 3, 1, 1, 1],
+        [2, 2, 3, 1, 4, 2, 2],
+        [1, 1, 1, 5, 0, 0, 0],
+    ], dtype=np.uint8)
+    _, _, state_diff = cn_transition_indices(adata)
+    assert state_diff.tolist() == [1, 1, -2, -2, 4]
+
+    # Non-integer differences are retained
+    adata.layers['state'] = np.array([
+        [2, 2.5, 2.5, 2.5, 1, 1, 1],
+        [2, 2, 2, 2, 2, 2, 2],
+        [1, 1, 1, 1, 1, 1, 1],
+    ])
+    cell_idx, bin_idx, state_diff = cn_transition_indices(adata)
+    assert cell_idx.tolist() == [0]
+    assert bin_idx.tolist() == [1]
+    assert state_diff.tolist() == [0.5]
+
+
+def test_cn_transition_regions():
+    adata = _example_adata()
+
+    cell_idx, region_idx, regions = cn_transition_regions(adata)
+
+    assert cell_idx.tolist() == [0, 1, 1, 2]
+    assert region_idx.tolist() == [0, 1, 3, 2]
+
+    # Regions span the midpoints of the bins adjacent to the transition
+    assert regions['chr'].tolist() == ['1', '1', '1', '2']
+    assert regions['start'].tolist() == [151, 251, 251, 51]
+    assert regions['end'].tolist() == [250, 350, 350, 150]
+    assert regions['orientation'].tolist() == ['-', '+', '-', '+']
+
+
+def test_transition_index_query_window():
+    index = TransitionIndex.from_anndata(_example_adata())
+
+    # Regions sorted by chromosome and start, with the number of cells
+    assert index.regions['start'].tolist() == [151, 251, 251, 51]
+    assert index.regions['cell_count'].tolist() == [1, 1, 1, 1]
+
+    # Window edges are inclusive
+    assert index.query_window('1', 250, 251)['start'].tolist() == [151, 251, 251]
+    assert index.query_window('1', 100, 151)['start'].tolist() == [151]
+    assert len(index.query_window('1', 100, 150)) == 0
+    assert len(index.query_window('1', 351, 1000)) == 0
+    assert len(index.query_window('3', 1, 1000)) == 0
+
+
+def test_transition_index_cells_in_window():
+    index = TransitionIndex.from_anndata(_example_adata())
+
+    assert index.cells_in_window('1', 300, 400).tolist() == ['c1', 'c2']
+    assert index.cells_in_window('1', 1, 250).tolist() == ['c0']
+    assert index.cells_in_window('2', 1, 51).tolist() == ['c1']
+    assert index.cells_in_window('2', 1, 50).tolist() == []
+    assert index.cells_in_window('3', 1, 1000).tolist() == []
+
+
+def test_transition_index_nearest():
+    index = TransitionIndex.from_anndata(_example_adata())
+
+    nearest = index.nearest('1', [100, 200, 255, 1000])
+    assert nearest['start'].tolist() == [151, 151, 251, 251]
+    assert nearest['distance'].tolist() == [51, 0, 0, 650]
+    assert nearest['position'].tolist() == [100, 200, 255, 1000]
+
+    # Restricted to the transitions of one cell
+    nearest = index.nearest('1', [1000], cell_id='c0')
+    assert nearest['start'].tolist() == [151]
+    assert nearest['distance'].tolist() == [750]
+
+    assert len(index.nearest('2', [1000], cell_id='c0')) == 0
+    assert len(index.nearest('3', [1])) == 0
+
+
+def test_transition_index_join_genes():
+    index = TransitionIndex.from_anndata(_example_adata())
+
+    genes = pd.DataFrame({
+        'chr': ['1', '2', '1', '1'],
+        'start': [240, 1, 1, 1],
+        'end': [260, 10, 150, 151],
+        'gene_id': ['g1', 'g2', 'g3', 'g4'],
+    })
+
+    joined = index.join_genes(genes)
+    assert sorted(zip(joined['gene_id'], joined['start'], joined['orientation'])) == [
+        ('g1', 151, '-'), ('g1', 251, '+'), ('g1', 251, '-'), ('g4', 151, '-')]
+
+    joined = index.join_genes(genes, per_cell=True)
+    assert sorted(zip(joined['gene_id'], joined['cell_id'])) == [
+        ('g1', 'c0'), ('g1', 'c1'), ('g1', 'c2'), ('g4', 'c0')]
@@ -0,0 +1,37 @@
+import numpy as np
+
+from scgenome.plotting.cn_colors import map_cn_colors
+from scgenome.plotting.heatmap import _downsample_matrix
+
+
+def test_downsample_mode_missing_blocks():
+    X = np.array([
+        [2., 2., np.nan, np.nan, 2.5, 2.5],
+        [2., 3., np.nan, np.nan, 2.5, 1.5],
+    ])
+
+    X_mode = _downsample_matrix(X, np.array([0]), np.array([0, 2, 4]), mode=True)
+
+    assert X_mode[0, 0] == 2
+    assert np.isnan(X_mode[0, 1])
+    assert np.isnan(X_mode[0, 2])
+
+    # Blocks without integer states are black, as without downsampling
+    colors = map_cn_colors(X_mode)
+    assert (colors[0, 1:] == 0).all()
+    assert (colors[0, 1:] == map_cn_colors(np.array([[np.nan, 2.5]]))).all()
+
+    X_nan = np.full((2, 2), np.nan)
+    assert np.isnan(_downsample_matrix(X_nan, np.array([0]), np.array([0]), mode=True)).all()
+
+
+def test_downsample_mode_integer_states():
+    X = np.array([
+        [0, 0, 5, 4],
+        [1, 0, 5, 5],
+    ], dtype=np.int8)
+
+    X_mode = _downsample_matrix(X, np.array([0]), np.array([0, 2]), mode=True)
+
+    assert X_mode.dtype == X.dtype
+    assert (X_mode == [[0, 5]]).all()
@@ -13,6 +13,7 @@ def test_imports():
     import scgenome.utils
     import scgenome.tools.ranges
     import scgenome.tools.getters
+    import scgenome.tools.cntransitions
 
     print(scgenome.pl.plot_cn_profile)
     print(scgenome.pl.plot_var_profile)
@@ -20,6 +21,7 @@ def test_imports():
     print(scgenome.pl.plot_cell_cn_matrix_fig)
     print(scgenome.pl.cn_legend)
     print(scgenome.pl.plot_gc_reads)
+    print(scgenome.pl.plot_tree)
     print(scgenome.pl.plot_tree_cn)
 
 
@@ -32,6 +34,7 @@ def test_imports():
     print(scgenome.pp.read_bam_bin_counts)
     print(scgenome.pp.read_medicc2_cn)
     print(scgenome.pp.read_snv_genotyping)
+    print(scgenome.pp.apply_dtype_policy)
 
 
     print(scgenome.tl.cluster_cells)
@@ -39,6 +42,7 @@ def test_imports():
     print(scgenome.tl.aggregate_clusters_hmmcopy)
     print(scgenome.tl.aggregate_clusters)
     print(scgenome.tl.compute_umap)
+    print(scgenome.tl.compute_neighbors)
     print(scgenome.tl.pca_loadings)
     print(scgenome.tl.sort_cells)
     print(scgenome.tl.sort_clusters)
@@ -47,13 +51,25 @@ def test_imports():
     print(scgenome.tl.add_cyto_giemsa_stain)
     print(scgenome.tl.read_ensemble_genes_gtf)
     print(scgenome.tl.aggregate_genes)
+    print(scgenome.tl.aggregate_gene_sets)
+    print(scgenome.tl.bin_gene_weights)
     print(scgenome.tl.ad_concat_cells)
     print(scgenome.tl.prune_leaves)
     print(scgenome.tl.align_cn_tree)
+    print(scgenome.tl.get_phylo_order)
+    print(scgenome.tl.ArrayTree)
+    print(scgenome.tl.aggregate_clades)
     print(scgenome.tl.create_bins)
     print(scgenome.tl.rebin)
     print(scgenome.tl.rebin_regular)
     print(scgenome.tl.weighted_mean)
     print(scgenome.tl.bin_width_weighted_mean)
     print(scgenome.tl.get_obs_data)
+    print(scgenome.tl.get_feature_matrix)
+    print(scgenome.tl.clear_feature_cache)
 
+
+    print(scgenome.tools.cntransitions.cn_transition_indices)
+    print(scgenome.tools.cntransitions.cn_transition_regions)
+    print(scgenome.tools.cntransitions.cn_transition_pair_counts)
+    print(scgenome.tools.cntransitions.TransitionIndex)
@@ -0,0 +1,178 @@
+import copy
+import warnings
+import anndata as ad
+import Bio.Phylo.BaseTree
+import numpy as np
+import pandas as pd
+import pytest
+
+from scgenome.tools.phylo import ArrayTree, aggregate_clades, prune_leaves
+
+
+def test_array_tree_requires_depth_first_preorder():
+    names = [None, None, None, 'x', 'y', 'z', 'w']
+    branch_length = np.ones(7)
+
+    tree = ArrayTree([-1, 0, 1, 1, 0, 4, 4], branch_length, names)
+    assert tree.clade_leaves(4).tolist() == ['z', 'w']
+
+    # Breadth first order has parents before children but clades are not contiguous
+    with pytest.raises(ValueError):
+        ArrayTree([-1, 0, 0, 1, 1, 2, 2], branch_length, names)
+
+    with pytest.raises(ValueError):
+        ArrayTree([-1, 0, -1], np.ones(3), [None, 'x', 'y'])
+
+
+def _random_tree(n_leaves, seed):
+    """ Random tree with multifurcating and unary clades
+    """
+    rng = np.random.default_rng(seed)
+    clades = [Bio.Phylo.BaseTree.Clade(branch_length=float(rng.random()), name=f'cell{i}') for i in range(n_leaves)]
+    k = 0
+    while len(clades) > 1:
+        n_children = min(len(clades), rng.choice([2, 2, 3]))
+        idx = sorted(rng.choice(len(clades), n_children, replace=False), reverse=True)
+        children = [clades.pop(i) for i in idx]
+        clade = Bio.Phylo.BaseTree.Clade(branch_length=float(rng.random()), clades=children, name=f'internal{k}')
+        k += 1
+        if rng.random() < 0.2:
+            clade = Bio.Phylo.BaseTree.Clade(branch_length=float(rng.random()), clades=[clade], name=f'internal{k}')
+            k += 1
+        clades.append(clade)
+    return Bio.Phylo.BaseTree.Tree(root=clades[0], rooted=True)
+
+
+def _baseline_prune_leaves(tree, f):
+    """ Prune by repeatedly calling `tree.prune` on terminals
+    """
+    while tree.count_terminals() > 0:
+        altered = False
+        for a in tree.get_terminals():
+            if f(a):
+                tree.prune(a)
+                altered = True
+        if not altered:
+            break
+
+
+def _assert_trees_equal(tree1, tree2):
+    assert (tree1.parent == tree2.parent).all()
+    assert tree1.names.tolist() == tree2.names.tolist()
+
+    # Bio.Phylo removes the branch length of a collapsed root
+    assert np.allclose(tree1.branch_length[1:], tree2.branch_length[1:])
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_prune(seed):
+    rng = np.random.default_rng(seed)
+    bio_tree = _random_tree(30, seed)
+    tree = ArrayTree.from_biophylo(bio_tree)
+
+    for fraction in (0.1, 0.5, 0.9):
+        keep = rng.random(len(tree.leaf_order)) > fraction
+        keep[rng.integers(len(keep))] = True
+        keep_names = set(tree.leaf_names[keep])
+
+        pruned = tree.prune(keep)
+        assert set(pruned.leaf_names) == keep_names
+        assert (pruned.prune(pruned.leaf_names).parent == pruned.parent).all()
+        _assert_trees_equal(pruned, tree.prune(list(keep_names)))
+
+        expected = copy.deepcopy(bio_tree)
+        _baseline_prune_leaves(expected, lambda a: a.name not in keep_names)
+        _assert_trees_equal(pruned, ArrayTree.from_biophylo(expected))
+
+        result = copy.deepcopy(bio_tree)
+        prune_leaves(result, lambda a: a.name not in keep_names)
+        _assert_trees_equal(pruned, ArrayTree.from_biophylo(result))
+
+    with pytest.raises(ValueError):
+        tree.prune(np.zeros(len(tree.leaf_order), dtype=bool))
+
+
+def test_biophylo_newick_round_trip():
+    bio_tree = _random_tree(20, 0)
+    tree = ArrayTree.from_biophylo(bio_tree)
+
+    assert tree.leaf_names.tolist() == [a.name for a in bio_tree.get_terminals()]
+    assert tree.n_nodes == len(list(bio_tree.find_clades()))
+    for node in np.flatnonzero(~tree.is_leaf):
+        clade = next(bio_tree.find_clades(tree.names[node]))
+        assert tree.clade_leaves(node).tolist() == [a.name for a in clade.get_terminals()]
+
+    _assert_trees_equal(tree, ArrayTree.from_biophylo(tree.to_biophylo()))
+
+    newick = tree.to_newick()
+    round_trip = ArrayTree.from_newick(newick)
+    _assert_trees_equal(tree, round_trip)
+    assert round_trip.to_newick() == newick
+
+
+def test_coordinates():
+    #      root
+    #     /    \
+    #    a      b
+    #   / \   / | \
+    #  x   y z  v  w
+    tree = ArrayTree.from_newick('((x:1,y:2)a:1,(z:1,v:1,w:3)b:2)root;')
+    x, y = tree.coordinates()
+
+    assert tree.names.tolist() == ['root', 'a', 'x', 'y', 'b', 'z', 'v', 'w']
+    assert x.tolist() == [0, 1, 2, 3, 2, 3, 3, 5]
+    assert y.tolist() == [1.75, 0.5, 0, 1, 3, 2, 3, 4]
+
+    # Unit branch lengths if missing
+    x, y = ArrayTree.from_newick('((x,y)a,(z,v,w)b)root;').coordinates()
+    assert x.tolist() == [0, 1, 2, 2, 1, 2, 2, 2]
+    assert y.tolist() == [1.75, 0.5, 0, 1, 3, 2, 3, 4]
+
+
+def _clade_adata(tree, seed):
+    """ Cells of a tree with low and high cardinality layers with missing values
+    """
+    rng = np.random.default_rng(seed)
+    n_cells, n_bins = len(tree.leaf_order), 50
+
+    state = rng.integers(0, 5, size=(n_cells, n_bins)).astype(float)
+    state[rng.random(state.shape) < 0.1] = np.nan
+    state[:, 0] = np.nan
+
+    reads = rng.integers(0, 1000, size=(n_cells, n_bins)).astype(float)
+    reads[rng.random(reads.shape) < 0.1] = np.nan
+
+    copy = rng.normal(2., 1., size=(n_cells, n_bins))
+    copy[rng.random(copy.shape) < 0.1] = np.nan
+
+    obs = pd.DataFrame(index=tree.leaf_names)
+    return ad.AnnData(state, obs=obs, layers={'state': state, 'reads': reads, 'copy': copy})
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('max_chunk_elements', [10000000, 100])
+def test_aggregate_clades(shuffle, max_chunk_elements):
+    tree = ArrayTree.from_biophylo(_random_tree(40, 0))
+    adata = _clade_adata(tree, 0)
+    if shuffle:
+        adata = adata[np.random.default_rng(0).permutation(adata.shape[0])].copy()
+
+    agg_layers = {'state': 'median', 'reads': 'median', 'copy': 'mean'}
+    clade_adata = aggregate_clades(
+        tree, adata, agg_X='mode', agg_layers=agg_layers, include_leaves=True,
+        max_chunk_elements=max_chunk_elements)
+
+    assert clade_adata.obs['node'].tolist() == list(range(tree.n_nodes))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for node in range(tree.n_nodes):
+            clade_cells = adata[tree.clade_leaves(node)]
+            assert clade_adata.obs['clade_size'].iloc[node] == clade_cells.shape[0]
+
+            expected_mode = pd.DataFrame(np.array(clade_cells.X)).mode().iloc[0].values
+            assert np.array_equal(clade_adata.X[node], expected_mode, equal_nan=True)
+
+            for layer_name, agg_f in (('state', np.nanmedian), ('reads', np.nanmedian), ('copy', np.nanmean)):
+                expected = agg_f(np.array(clade_cells.layers[layer_name]), axis=0)
+                assert np.allclose(clade_adata.layers[layer_name][node], expected, equal_nan=True)
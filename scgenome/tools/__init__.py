@@ -1,10 +1,10 @@
 
-from .cluster import cluster_cells, cluster_cells, detect_outliers, aggregate_clusters_hmmcopy, aggregate_clusters, compute_umap
+from .cluster import cluster_cells, cluster_cells, detect_outliers, aggregate_clusters_hmmcopy, aggregate_clusters, compute_umap, compute_neighbors
 from .pca import pca_loadings
 from .sorting import sort_cells, sort_clusters
 from .binfeat import count_gc, mean_from_bigwig, add_cyto_giemsa_stain
-from .genes import read_ensemble_genes_gtf, aggregate_genes
+from .genes import read_ensemble_genes_gtf, aggregate_genes, aggregate_gene_sets, bin_gene_weights
 from .concat import ad_concat_cells
-from .phylo import prune_leaves, align_cn_tree
+from .phylo import prune_leaves, align_cn_tree, get_phylo_order, ArrayTree, aggregate_clades
 from .ranges import create_bins, rebin, rebin_regular, weighted_mean, bin_width_weighted_mean
-from .getters import get_obs_data
+from .getters import get_obs_data, get_feature_matrix, clear_feature_cache
@@ -1,11 +1,15 @@
 import logging
 import sklearn.cluster
+import sklearn.ensemble
+import sklearn.neighbors
 import sklearn.mixture
 import sklearn.preprocessing
 import umap
+import umap.umap_
 import pandas as pd
 import numpy as np
 import anndata as ad
+import scipy.sparse
 from natsort import natsorted
 
 from anndata import AnnData
@@ -14,6 +18,8 @@ from collections.abc import Iterable
 
 import scgenome.cncluster
 import scgenome.preprocessing.transform
+import scgenome.preprocessing.dtype_policy
+import scgenome.tools.getters
 
 
 def _kmeans_bic(X, k):
@@ -41,9 +47,12 @@ def cluster_cells(
         cell_ids: Iterable[str]=None,
         bin_ids: Iterable[str]=None,
         standardize: bool=False,
+        use_rep: str=None,
     ) -> AnnData:
     """ Cluster cells by copy number.
 
+    Sparse layers are clustered without densifying for the 'kmeans_bic' method.
+
     Parameters
     ----------
     adata : AnnData
@@ -62,6 +71,9 @@ def cluster_cells(
         subset of bins to cluster, by default None
     standarize : bool
         standardize the data prior to outlier detection, by default False
+    use_rep : str, optional
+        cluster on a cell embedding in obsm such as 'X_pca' instead of layers, by default None
+
     Returns
     -------
     AnnData
@@ -98,23 +110,12 @@ def cluster_cells(
     min_k = min(adata.shape[0], min_k)
     max_k = min(adata.shape[0], max_k)
 
-    def __get_layer(layer_name):
-        if layer_name is not None:
-            return np.array(adata[cell_ids, bin_ids].layers[layer_name])
-        else:
-            return np.array(adata[cell_ids, bin_ids].X)
+    # Sparse data is scaled but not centered, centering does not affect clustering
+    X = scgenome.tools.getters.get_feature_matrix(
+        adata, layer_name, cell_ids=cell_ids, bin_ids=bin_ids, standardize=standardize, use_rep=use_rep)
 
-    if isinstance(layer_name, (str, type(None))):
-        X = __get_layer(layer_name)
-    elif isinstance(layer_name, Iterable):
-        X = np.concatenate([__get_layer(l) for l in layer_name], axis=1)
-    else:
-        raise ValueError(f'layer_name was {layer_name}')
-
-    X = scgenome.preprocessing.transform.fill_missing(X)
-    
-    if standardize:
-        X = sklearn.preprocessing.StandardScaler().fit_transform(X)
+    if scipy.sparse.issparse(X) and method != 'kmeans_bic':
+        X = X.toarray()
 
     ks = range(min_k, max_k + 1)
 
@@ -153,19 +154,64 @@ def cluster_cells(
         cell_ids=np.array(cell_ids),
         bin_ids=np.array(bin_ids),
         standardize=standardize,
+        use_rep=use_rep,
     )
 
     return adata
 
 
+def _cluster_deviation_scores(X, clusters, chunk_size=None):
+    """ Score cells by mean absolute deviation from the median profile of their cluster.
+    """
+    codes, cluster_ids = pd.factorize(clusters)
+
+    consensus = np.zeros((len(cluster_ids), X.shape[1]))
+    for k in range(len(cluster_ids)):
+        X_k = X[codes == k]
+        if scipy.sparse.issparse(X_k):
+            X_k = X_k.toarray()
+        consensus[k] = np.median(X_k, axis=0)
+
+    if chunk_size is None:
+        chunk_size = scgenome.tools.getters.default_chunk_size
+
+    scores = np.zeros(X.shape[0])
+    for start, end in scgenome.tools.getters.chunk_ranges(X.shape[0], chunk_size=chunk_size):
+        cells = slice(start, end)
+        chunk = X[cells]
+        if scipy.sparse.issparse(chunk):
+            chunk = chunk.toarray()
+        scores[cells] = np.mean(np.abs(chunk - consensus[codes[cells]]), axis=1)
+
+    # Robust z-score of each cell's deviation relative to its cluster
+    score_median = pd.Series(scores).groupby(codes).transform('median').values
+    score_mad = pd.Series(np.abs(scores - score_median)).groupby(codes).transform('median').values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z_scores = (scores - score_median) / (1.4826 * score_mad)
+    z_scores[score_mad == 0] = 0
+
+    return scores, z_scores
+
+
 def detect_outliers(
         adata: AnnData,
         layer_name: Union[None, str, Iterable[Union[None,str]]]='copy',
         method: str='isolation_forest',
         standarize: bool=False,
+        use_rep: str=None,
+        max_samples: Union[None, int, float]=None,
+        n_jobs: int=None,
+        cluster_col: str='cluster_id',
+        threshold: float=3.5,
+        random_state: int=100,
     ) -> AnnData:
     """ Detect outlier cells by copy number.
 
+    The 'cluster_deviation' method scores each cell by the mean absolute deviation
+    from the median profile of its cluster, and flags cells with a robust z-score
+    of the deviation above `threshold` relative to other cells in the cluster.
+    It requires no model fitting and scales to large numbers of cells.
+
     Parameters
     ----------
     adata : AnnData
@@ -173,61 +219,170 @@ def detect_outliers(
     layer_name : str, optional
         layer with copy number data to use for outlier detection, None for X, by default 'copy'
     method : str, optional
-        outlier method, by default 'isolation_forest'
+        outlier method, one of 'isolation_forest', 'local_outlier_factor' or
+        'cluster_deviation', by default 'isolation_forest'
     standarize : bool
         standardize the data prior to outlier detection, by default False
+    use_rep : str, optional
+        use a cell embedding in obsm such as 'X_pca' instead of layers, by default None
+    max_samples : int or float, optional
+        number or fraction of cells used to fit the model, by default None, the
+        IsolationForest default for 'isolation_forest' and all cells for 'local_outlier_factor'
+    n_jobs : int, optional
+        number of parallel jobs for 'isolation_forest' and 'local_outlier_factor', by default None
+    cluster_col : str, optional
+        obs column with clusters for 'cluster_deviation', None or a missing column
+        to compare all cells to a single consensus, by default 'cluster_id'
+    threshold : float, optional
+        robust z-score threshold for 'cluster_deviation', by default 3.5
+    random_state : int, optional
+        random state for model fitting and subsampling, by default 100
 
     Returns
     -------
     AnnData
-        copy number data with additional `is_outlier` column
+        copy number data with additional `is_outlier` and `outlier_score` columns,
+        higher scores are more outlying
 
     """
-    def __get_layer(layer_name):
-        if layer_name is not None:
-            return np.array(adata.layers[layer_name])
-        else:
-            return np.array(adata.X)
-
-    if isinstance(layer_name, str):
-        X = __get_layer(layer_name)
-    elif isinstance(layer_name, Iterable):
-        X = np.concatenate([__get_layer(l) for l in layer_name], axis=1)
-
-    X = scgenome.preprocessing.transform.fill_missing(X)
-
-    if standarize:
-        X = sklearn.preprocessing.StandardScaler().fit_transform(X)
+    X = scgenome.tools.getters.get_feature_matrix(adata, layer_name, standardize=standarize, use_rep=use_rep)
 
     if method == 'isolation_forest':
-        model = sklearn.ensemble.IsolationForest(random_state=100)
+        model = sklearn.ensemble.IsolationForest(
+            max_samples='auto' if max_samples is None else max_samples,
+            n_jobs=n_jobs,
+            random_state=random_state)
         is_outlier = (model.fit_predict(X) == -1) * 1
+        outlier_score = -model.score_samples(X)
+
     elif method == 'local_outlier_factor':
-        model = sklearn.neighbors.LocalOutlierFactor()
-        is_outlier = (model.fit_predict(X) == -1) * 1
+        if max_samples is None:
+            model = sklearn.neighbors.LocalOutlierFactor(n_jobs=n_jobs)
+            is_outlier = (model.fit_predict(X) == -1) * 1
+            outlier_score = -model.negative_outlier_factor_
+
+        else:
+            # Fit on a subsample of cells and score the remaining cells against it,
+            # sampled cells are scored as in the fit to exclude themselves as neighbors
+            n_samples = max_samples if isinstance(max_samples, (int, np.integer)) else int(max_samples * X.shape[0])
+            n_samples = min(max(n_samples, 2), X.shape[0])
+            rng = np.random.default_rng(random_state)
+            is_sampled = np.zeros(X.shape[0], dtype=bool)
+            is_sampled[rng.choice(X.shape[0], size=n_samples, replace=False)] = True
+            model = sklearn.neighbors.LocalOutlierFactor(n_neighbors=min(20, n_samples - 1), novelty=True, n_jobs=n_jobs)
+            model.fit(X[is_sampled])
+
+            outlier_score = np.empty(X.shape[0])
+            outlier_score[is_sampled] = -model.negative_outlier_factor_
+            if not is_sampled.all():
+                outlier_score[~is_sampled] = -model.score_samples(X[~is_sampled])
+            is_outlier = (-outlier_score < model.offset_) * 1
+
+    elif method == 'cluster_deviation':
+        if cluster_col is not None and cluster_col in adata.obs:
+            clusters = adata.obs[cluster_col].values
+        else:
+            clusters = np.zeros(adata.shape[0], dtype=int)
+        _, outlier_score = _cluster_deviation_scores(X, clusters)
+        is_outlier = (outlier_score > threshold) * 1
+
     else:
         raise ValueError(f'unknown method {method}')
 
     adata.obs['is_outlier'] = pd.Series(is_outlier, index=adata.obs.index, dtype='category')
+    adata.obs['outlier_score'] = outlier_score
 
     # store information on the clustering parameters
-    adata.uns['outliers'] = {}
-    adata.uns['outliers']['params'] = dict(
-        method='isolation_forest',
+    params = dict(
+        method=method,
         layer_name=layer_name,
         standarize=standarize,
+        use_rep=use_rep,
+        max_samples=max_samples,
+        cluster_col=cluster_col if method == 'cluster_deviation' else None,
+        threshold=threshold if method == 'cluster_deviation' else None,
     )
+    adata.uns['outliers'] = {}
+    adata.uns['outliers']['params'] = {k: v for k, v in params.items() if v is not None}
 
     return adata
 
 
+_chunked_sum_functions = (np.sum, np.nansum, 'sum')
+_chunked_mean_functions = (np.mean, np.nanmean, 'mean')
+
+
+def _aggregate_layer_chunked(adata, layer_name, agg_f, clusters, chunk_size):
+    """ Aggregate a layer by cluster reading chunks of cells.
+
+    Sums and means are accumulated across chunks, other aggregate functions
+    are applied to the cells of one cluster at a time.
+    """
+    codes, cluster_ids = pd.factorize(clusters, sort=True)
+    n_clusters = len(cluster_ids)
+
+    if isinstance(agg_f, str) or callable(agg_f):
+        is_sum = any(agg_f is f for f in _chunked_sum_functions) or agg_f == 'sum'
+        is_mean = any(agg_f is f for f in _chunked_mean_functions) or agg_f == 'mean'
+    else:
+        is_sum = is_mean = False
+
+    if is_sum or is_mean:
+        sums = np.zeros((n_clusters, adata.shape[1]))
+        counts = np.zeros((n_clusters, adata.shape[1]))
+        for cells, chunk in scgenome.tools.getters.iter_layer_chunks(adata, layer_name, chunk_size=chunk_size):
+            indicator = scipy.sparse.csr_matrix(
+                (np.ones(cells.stop - cells.start), (codes[cells], np.arange(cells.stop - cells.start))),
+                shape=(n_clusters, cells.stop - cells.start))
+            if scipy.sparse.issparse(chunk):
+                # Implicit zeros are present, explicit nan are missing
+                is_nan = chunk.copy()
+                is_nan.data = np.isnan(is_nan.data) * 1.
+                chunk = chunk.copy()
+                chunk.data[np.isnan(chunk.data)] = 0
+                sums += (indicator @ chunk).toarray()
+                counts += np.asarray(indicator.sum(axis=1)) - (indicator @ is_nan).toarray()
+            else:
+                is_nan = np.isnan(chunk)
+                sums += indicator @ np.where(is_nan, 0, chunk)
+                counts += indicator @ (~is_nan)
+
+        if is_sum:
+            data = sums
+        else:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                data = sums / counts
+            data[counts == 0] = np.nan
+
+    else:
+        if layer_name is not None:
+            layer_data = adata.layers[layer_name]
+        else:
+            layer_data = adata.X
+
+        data = []
+        for cluster_idx in range(n_clusters):
+            cells = np.where(codes == cluster_idx)[0]
+            chunk = layer_data[cells]
+            if scipy.sparse.issparse(chunk):
+                chunk = chunk.toarray()
+            data.append(pd.DataFrame(np.asarray(chunk)).agg(agg_f).values)
+
+    return pd.DataFrame(
+        np.array(data),
+        index=pd.Index(cluster_ids, name=clusters.name),
+        columns=adata.var.index)
+
+
 def aggregate_clusters(
         adata: AnnData,
         agg_X: Any=None,
         agg_layers: Dict=None,
         agg_obs: Dict=None,
         cluster_col: str='cluster_id',
-        cluster_size_col: str='cluster_size') -> AnnData:
+        cluster_size_col: str='cluster_size',
+        dtype_policy=None,
+        chunk_size: int=None) -> AnnData:
     """ Aggregate copy number by cluster to create cluster CN matrix
 
     Parameters
@@ -244,6 +399,11 @@ def aggregate_clusters(
         column with cluster ids, by default 'cluster_id'
     cluster_size_col : str, optional
         column that will be set to the size of each cluster, by default 'cluster_size'
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
+    chunk_size : int, optional
+        number of cells to aggregate at a time, by default None, all cells at
+        once unless adata is backed
 
     Returns
     -------
@@ -251,14 +411,22 @@ def aggregate_clusters(
         aggregated cluster copy number
     """
 
-    if agg_X is not None:
-        X = (
+    if chunk_size is None and adata.isbacked:
+        chunk_size = scgenome.tools.getters.default_chunk_size
+
+    def __aggregate_layer(layer_name, agg_f):
+        if chunk_size is not None:
+            return _aggregate_layer_chunked(adata, layer_name, agg_f, adata.obs[cluster_col].astype(str), chunk_size)
+        return (
             adata
-                .to_df()
+                .to_df(layer=layer_name)
                 .set_index(adata.obs[cluster_col].astype(str))
                 .groupby(level=0)
-                .agg(agg_X)
+                .agg(agg_f)
                 .sort_index())
+
+    if agg_X is not None:
+        X = __aggregate_layer(None, agg_X)
         dtypes = X.dtypes.unique()
         assert len(dtypes) == 1
         dtype = dtypes[0]
@@ -271,13 +439,7 @@ def aggregate_clusters(
     if agg_layers is not None:
         layer_data = {}
         for layer_name in agg_layers:
-            layer_data[layer_name] = (
-                adata
-                    .to_df(layer=layer_name)
-                    .set_index(adata.obs[cluster_col].astype(str))
-                    .groupby(level=0)
-                    .agg(agg_layers[layer_name])
-                    .sort_index())
+            layer_data[layer_name] = __aggregate_layer(layer_name, agg_layers[layer_name])
 
     obs_data = {}
     obs_data[cluster_size_col] = (
@@ -305,6 +467,8 @@ def aggregate_clusters(
         layers=layer_data,
     )
 
+    adata = scgenome.preprocessing.dtype_policy.apply_dtype_policy(adata, dtype_policy)
+
     return adata
 
 
@@ -336,6 +500,101 @@ def aggregate_clusters_hmmcopy(adata: AnnData) -> AnnData:
     return aggregate_clusters(adata, agg_X, agg_layers, agg_obs, cluster_col='cluster_id')
 
 
+def _knn_to_graph(knn_indices: np.ndarray, knn_dists: np.ndarray) -> scipy.sparse.csr_matrix:
+    """ Convert knn arrays including self as the first neighbor to a distances graph excluding self
+    """
+    n_cells, n_neighbors = knn_indices.shape
+    # Constructed directly to retain explicit zero distances
+    return scipy.sparse.csr_matrix(
+        (knn_dists[:, 1:].ravel(), knn_indices[:, 1:].ravel(), np.arange(n_cells + 1) * (n_neighbors - 1)),
+        shape=(n_cells, n_cells))
+
+
+def _graph_to_knn(graph: scipy.sparse.csr_matrix):
+    """ Convert a distances graph excluding self to knn arrays including self as the first neighbor
+    """
+    graph = scipy.sparse.csr_matrix(graph)
+    n_cells = graph.shape[0]
+    row_counts = np.diff(graph.indptr)
+    if len(np.unique(row_counts)) != 1:
+        return None
+    n_neighbors = row_counts[0] + 1
+
+    knn_indices = graph.indices.reshape(n_cells, n_neighbors - 1)
+    knn_dists = graph.data.reshape(n_cells, n_neighbors - 1)
+
+    order = np.argsort(knn_dists, axis=1, kind='stable')
+    knn_indices = np.take_along_axis(knn_indices, order, axis=1)
+    knn_dists = np.take_along_axis(knn_dists, order, axis=1)
+
+    knn_indices = np.concatenate([np.arange(n_cells)[:, np.newaxis], knn_indices], axis=1)
+    knn_dists = np.concatenate([np.zeros((n_cells, 1), dtype=knn_dists.dtype), knn_dists], axis=1)
+
+    return knn_indices, knn_dists
+
+
+def compute_neighbors(
+        adata: AnnData,
+        layer_name: str='copy',
+        use_rep: str=None,
+        n_neighbors: int=15,
+        metric: str='euclidean',
+        key_added: str='neighbors',
+        random_state: int=42,
+        n_jobs: int=-1,
+    ) -> AnnData:
+    """ Compute a k nearest neighbor graph of cells.
+
+    Parameters
+    ----------
+    adata : AnnData
+        copy number data
+    layer_name : str, optional
+        layer with copy number data on which to compute neighbors, None for X, by default 'copy'
+    use_rep : str, optional
+        use a cell embedding in obsm such as 'X_pca' instead of layers, by default None
+    n_neighbors : int, optional
+        number of neighbors including the cell itself, by default 15
+    metric : str, optional
+        distance metric, by default 'euclidean'
+    key_added : str, optional
+        key of the graph in obsp and parameters in uns, by default 'neighbors'
+    random_state : int, optional
+        random state of the approximate nearest neighbor search, by default 42
+    n_jobs : int, optional
+        number of parallel jobs, by default -1, all processors
+
+    Returns
+    -------
+    AnnData
+        copy number data with distances graph in obsp[key_added] and parameters in uns[key_added]
+    """
+
+    X = scgenome.tools.getters.get_feature_matrix(adata, layer_name, use_rep=use_rep)
+
+    knn_indices, knn_dists, _ = umap.umap_.nearest_neighbors(
+        X,
+        n_neighbors=n_neighbors,
+        metric=metric,
+        metric_kwds={},
+        angular=False,
+        random_state=np.random.RandomState(random_state),
+        n_jobs=n_jobs,
+    )
+
+    adata.obsp[key_added] = _knn_to_graph(knn_indices, knn_dists)
+
+    adata.uns[key_added] = {}
+    adata.uns[key_added]['params'] = dict(
+        n_neighbors=n_neighbors,
+        metric=metric,
+        layer_name=layer_name if layer_name is not None else '',
+        use_rep=use_rep if use_rep is not None else '',
+    )
+
+    return adata
+
+
 def compute_umap(
         adata: AnnData,
         layer_name: str='copy',
@@ -343,9 +602,18 @@ def compute_umap(
         n_neighbors: int=15,
         min_dist: float=0.1,
         metric: str='euclidean',
+        use_rep: str=None,
+        neighbors_key: str=None,
+        random_state: int=42,
+        n_jobs: int=-1,
     ) -> AnnData:
     """ Cluster cells by copy number.
 
+    The nearest neighbor search dominates runtime, and can be reused across
+    calls by specifying `neighbors_key`.  An existing graph from
+    `compute_neighbors` is used if present and computed with the same
+    parameters, otherwise it is computed and stored for subsequent calls.
+
     Parameters
     ----------
     adata : AnnData
@@ -359,29 +627,56 @@ def compute_umap(
         umap n_neighbors param
     min_dist : float
         umap min_dist param
+    metric : str
+        umap metric param
+    use_rep : str, optional
+        use a cell embedding in obsm such as 'X_pca' instead of layers, by default None
+    neighbors_key : str, optional
+        key of a nearest neighbor graph in obsp to use or store, by default None
+    random_state : int, optional
+        umap random_state param, None for faster parallel non-deterministic results, by default 42
+    n_jobs : int, optional
+        umap n_jobs param, by default -1, all processors
 
     Returns
     -------
     AnnData
-        copy number data with additional `umap_1`, `umap_2` columns
+        copy number data with additional `UMAP1`, `UMAP2` columns and embedding in obsm['X_umap']
     """
 
-    if layer_name is not None:
-        X = adata.layers[layer_name]
-    else:
-        X = adata.X
+    X = scgenome.tools.getters.get_feature_matrix(adata, layer_name, use_rep=use_rep)
+
+    precomputed_knn = (None, None, None)
+    if neighbors_key is not None:
+        params = adata.uns.get(neighbors_key, {}).get('params', {})
+        is_matching = (
+            neighbors_key in adata.obsp and
+            params.get('n_neighbors') == n_neighbors and
+            params.get('metric') == metric and
+            params.get('layer_name') == (layer_name if layer_name is not None else '') and
+            params.get('use_rep') == (use_rep if use_rep is not None else ''))
+
+        if not is_matching:
+            compute_neighbors(
+                adata, layer_name=layer_name, use_rep=use_rep, n_neighbors=n_neighbors,
+                metric=metric, key_added=neighbors_key, random_state=random_state, n_jobs=n_jobs)
 
-    X = scgenome.preprocessing.transform.fill_missing(X)
+        knn = _graph_to_knn(adata.obsp[neighbors_key])
+        if knn is not None:
+            precomputed_knn = knn + (None,)
 
     embedding = umap.UMAP(
         n_neighbors=n_neighbors,
         min_dist=min_dist,
         n_components=n_components,
         metric=metric,
-        random_state=42,
+        random_state=random_state,
+        n_jobs=n_jobs,
+        precomputed_knn=precomputed_knn,
     ).fit_transform(X)
 
     adata.obs['UMAP1'] = embedding[:, 0]
     adata.obs['UMAP2'] = embedding[:, 1]
+    adata.obsm['X_umap'] = embedding
 
     return adata
@@ -1,23 +1,123 @@
-from numba import jit
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
+import scgenome.tools.getters
 
-@jit(nopython=True)
-def count_pairs(group_items):
-    num_items = group_items.shape[1]
-    pair_counts = np.zeros((num_items, num_items))
-    for group_idx in range(group_items.shape[0]):
-        items = np.where(group_items[group_idx] == 1)[0]
-        for item_idx1 in items:
-            for item_idx2 in items:
-                pair_counts[item_idx1, item_idx2] += 1
-    return pair_counts
+
+def _sorted_bin_order(var):
+    """ Order of bins sorted by chromosome and start, and whether each sorted bin
+    is on the same chromosome as the previous sorted bin.
+    """
+    chr_codes = pd.factorize(var['chr'])[0]
+    order = np.lexsort((var['start'].values, chr_codes))
+    same_chr = np.zeros(len(order), dtype=bool)
+    same_chr[1:] = chr_codes[order][1:] == chr_codes[order][:-1]
+    return order, same_chr
+
+
+def cn_transition_indices(adata, layer_name='state', chunk_size=None):
+    """ Find copy number transitions between adjacent bins of each cell.
+
+    Transitions are computed as differences between adjacent bins within
+    each chromosome, one chunk of cells at a time.  Differences involving
+    missing values are not transitions.
+
+    Args:
+        adata (AnnData): copy number data with chr and start in var
+        layer_name (str, optional): layer with copy number states, None for X. Defaults to 'state'.
+        chunk_size (int, optional): number of cells to process at a time. Defaults to None.
+
+    Returns:
+        tuple: int32 arrays of cell index and index of the bin following the transition,
+            and array of state difference across the transition, signed with the
+            precision of the layer, ordered by cell and position
+
+    """
+
+    order, same_chr = _sorted_bin_order(adata.var)
+    is_sorted = np.array_equal(order, np.arange(len(order)))
+
+    cell_idx = []
+    bin_idx = []
+    state_diff = []
+
+    for cells, chunk in scgenome.tools.getters.iter_layer_chunks(adata, layer_name, chunk_size=chunk_size):
+        if scipy.sparse.issparse(chunk):
+            chunk = chunk.toarray()
+        if not is_sorted:
+            chunk = chunk[:, order]
+
+        # Signed differences of unsigned states
+        if chunk.dtype.kind in 'ub':
+            chunk = chunk.astype(np.promote_types(chunk.dtype, np.int8))
+
+        diff = np.diff(chunk, axis=1)
+        is_transition = (diff != 0) & same_chr[np.newaxis, 1:]
+        if np.issubdtype(diff.dtype, np.floating):
+            is_transition &= ~np.isnan(diff)
+
+        chunk_cell_idx, chunk_pos = np.nonzero(is_transition)
+        cell_idx.append(chunk_cell_idx + cells.start)
+        bin_idx.append(order[chunk_pos + 1])
+        state_diff.append(diff[chunk_cell_idx, chunk_pos])
+
+    cell_idx = np.concatenate(cell_idx).astype(np.int32)
+    bin_idx = np.concatenate(bin_idx).astype(np.int32)
+    state_diff = np.concatenate(state_diff)
+
+    return cell_idx, bin_idx, state_diff
+
+
+def cn_transition_regions(adata, layer_name='state', chunk_size=None):
+    """ Find copy number transitions per cell and the unique regions they fall in.
+
+    Transition regions span the midpoints of the two bins adjacent to the
+    transition, computed from the bin widths, and have orientation '-' for
+    increases and '+' for decreases in copy number.
+
+    Args:
+        adata (AnnData): copy number data with chr, start and end in var
+        layer_name (str, optional): layer with copy number states, None for X. Defaults to 'state'.
+        chunk_size (int, optional): number of cells to process at a time. Defaults to None.
+
+    Returns:
+        tuple: int32 arrays of cell index and region index of each transition,
+            and DataFrame of regions with chr, start, end and orientation indexed by region index
+
+    """
+
+    cell_idx, bin_idx, state_diff = cn_transition_indices(adata, layer_name=layer_name, chunk_size=chunk_size)
+
+    order, _ = _sorted_bin_order(adata.var)
+    prev_bin = np.empty(len(order), dtype=int)
+    prev_bin[order[1:]] = order[:-1]
+
+    # Regions are unique by bin and orientation
+    region_codes, region_idx = np.unique(bin_idx.astype(np.int64) * 2 + (state_diff > 0), return_inverse=True)
+    region_bins = region_codes // 2
+
+    starts = adata.var['start'].values
+    ends = adata.var['end'].values
+    widths = ends - starts + 1
+
+    regions = pd.DataFrame({
+        'chr': adata.var['chr'].values[region_bins],
+        'start': starts[prev_bin[region_bins]] + widths[prev_bin[region_bins]] // 2,
+        'end': ends[region_bins] - widths[region_bins] // 2,
+        'orientation': np.where(region_codes % 2 == 1, '-', '+'),
+    })
+    regions.index.name = 'region_index'
+
+    return cell_idx, region_idx.astype(np.int32), regions
 
 
 def generate_cn_transitions(cn_data):
     """ Generate a list of copy number transition regions per cell.
 
+    Transition regions span the midpoints of the two bins adjacent to the
+    transition, computed from the bin widths.
+
     Args:
         cn_data (DataFrame): copy number data
     
@@ -30,12 +130,20 @@ def generate_cn_transitions(cn_data):
     cn_transitions = cn_data.sort_values(['cell_id', 'chr', 'start'])[['cell_id', 'chr', 'start', 'end', 'state']]
     cn_transitions['state_diff'] = cn_transitions['state'].diff().fillna(0).astype(int)
     cn_transitions['chr_diff'] = (cn_transitions['chr'].shift(1) == cn_transitions['chr']) * 1
-    cn_transitions['transition'] = (cn_transitions['state_diff'] != 0) & (cn_transitions['chr_diff'] == 1)
-    cn_transitions['start'] -= int(500000/2)
-    cn_transitions['end'] -= int(500000/2)
+    cn_transitions['cell_diff'] = (cn_transitions['cell_id'].shift(1) == cn_transitions['cell_id']) * 1
+    cn_transitions['transition'] = (
+        (cn_transitions['state_diff'] != 0) &
+        (cn_transitions['chr_diff'] == 1) &
+        (cn_transitions['cell_diff'] == 1))
+    width = cn_transitions['end'] - cn_transitions['start'] + 1
+    prev_start = cn_transitions['start'].shift(1)
+    prev_width = width.shift(1)
     cn_transitions['orientation'] = '+'
     cn_transitions.loc[cn_transitions['state_diff'] > 0, 'orientation'] = '-'
-    cn_transitions = cn_transitions.query('transition')
+    cn_transitions['start'] = prev_start + prev_width // 2
+    cn_transitions['end'] = cn_transitions['end'] - width // 2
+    cn_transitions = cn_transitions.query('transition').drop(columns=['cell_diff'])
+    cn_transitions['start'] = cn_transitions['start'].astype(int)
     cn_transitions = cn_transitions.merge(
         cn_transitions[['chr', 'start', 'end', 'orientation']]
             .drop_duplicates()
@@ -68,11 +176,70 @@ def generate_cn_transition_counts(cn_data):
     return cn_transition_counts
 
 
-def generate_cn_transition_pair_counts(cn_data):
+def _transition_pair_counts(cell_idx, region_idx, n_cells, n_regions, min_support=1):
+    """ Count cells with each pair of transition regions as COO triples.
+    """
+    cell_regions = scipy.sparse.csr_matrix(
+        (np.ones(len(cell_idx), dtype=np.int32), (cell_idx, region_idx)),
+        shape=(n_cells, n_regions))
+
+    # Indicator of the region in the cell, regardless of duplicates
+    cell_regions.sum_duplicates()
+    cell_regions.data[:] = 1
+
+    pair_counts = (cell_regions.T @ cell_regions).tocsr()
+    pair_counts.sort_indices()
+    pair_counts = pair_counts.tocoo()
+
+    keep = pair_counts.data >= max(min_support, 1)
+
+    return (
+        pair_counts.row[keep].astype(np.int32),
+        pair_counts.col[keep].astype(np.int32),
+        pair_counts.data[keep].astype(np.int32),
+    )
+
+
+def cn_transition_pair_counts(adata, layer_name='state', min_support=1, chunk_size=None):
+    """ Count cells supporting each pair of copy number transition regions.
+
+    Pair counts are computed as the sparse product of the transpose of the cell by
+    region indicator matrix with itself, and only pairs supported by at least
+    min_support cells are returned.  The diagonal contains the cell count of each
+    region.
+
+    Args:
+        adata (AnnData): copy number data with chr, start and end in var
+        layer_name (str, optional): layer with copy number states, None for X. Defaults to 'state'.
+        min_support (int, optional): minimum number of cells with both regions. Defaults to 1.
+        chunk_size (int, optional): number of cells to process at a time. Defaults to None.
+
+    Returns:
+        tuple: DataFrame of region_index_1, region_index_2 and pair_cell_count,
+            and DataFrame of regions as returned by cn_transition_regions
+
+    """
+
+    cell_idx, region_idx, regions = cn_transition_regions(adata, layer_name=layer_name, chunk_size=chunk_size)
+
+    region_index_1, region_index_2, pair_cell_count = _transition_pair_counts(
+        cell_idx, region_idx, adata.shape[0], len(regions), min_support=min_support)
+
+    cn_transition_pairs = pd.DataFrame({
+        'region_index_1': region_index_1,
+        'region_index_2': region_index_2,
+        'pair_cell_count': pair_cell_count,
+    })
+
+    return cn_transition_pairs, regions
+
+
+def generate_cn_transition_pair_counts(cn_data, min_support=1):
     """ Generate a list of copy number transition pairs and their cell counts.
 
     Args:
         cn_data (DataFrame): copy number data
+        min_support (int, optional): minimum number of cells with both transitions. Defaults to 1.
     
     Returns:
         DataFrame: copy number transitions pairs and counts of supporting cells
@@ -81,35 +248,236 @@ def generate_cn_transition_pair_counts(cn_data):
 
     cn_transitions = generate_cn_transitions(cn_data)
 
-    # Build a matrix of pairs of transitions in the same cell
-    cell_transitions_matrix = pd.crosstab(
-        index=cn_transitions['cell_id'],
-        columns=cn_transitions['region_index'],
+    cell_idx, cell_ids = pd.factorize(cn_transitions['cell_id'])
+
+    # For each pair of transitions, count the number of cells with both
+    region_index_1, region_index_2, pair_cell_count = _transition_pair_counts(
+        cell_idx,
+        cn_transitions['region_index'].values,
+        len(cell_ids),
+        cn_transitions['region_index'].max() + 1,
+        min_support=min_support,
     )
 
-    # Possibly not necessary, but ensure the column ordering matches the column indexing
-    cell_transitions_matrix = cell_transitions_matrix.reindex(
-        columns=range(max(cell_transitions_matrix.columns) + 1))
+    cn_transitions_matrix = pd.DataFrame({
+        'region_index_1': region_index_1,
+        'region_index_2': region_index_2,
+        'pair_cell_count': pair_cell_count,
+    })
 
-    # For each pair of transitions, count the number of cells with both
-    # returned as a transition by transition matrix
-    cell_region_counts = count_pairs(cell_transitions_matrix.values)
+    return cn_transitions_matrix
 
-    # Create a stacked format matrix that does not include 0 entries
-    cell_region_counts[cell_region_counts == 0] = np.NaN
 
-    cell_region_counts = pd.DataFrame(
-        cell_region_counts,
-        columns=cell_transitions_matrix.columns,
-        index=cell_transitions_matrix.columns,
-    )
+class TransitionIndex(object):
+    """ Per chromosome sorted index of copy number transition regions.
+
+    Regions are sorted by chromosome and start, and the cells with a
+    transition in each region are stored as a sparse region by cell
+    indicator matrix, supporting window queries, nearest transition
+    lookups and joins with gene ranges without regenerating transitions.
+
+    Args:
+        cell_idx (ndarray): cell index of each transition
+        region_idx (ndarray): region index of each transition
+        regions (DataFrame): regions with chr, start, end and orientation indexed by region index
+        cell_ids (Index): cell ids
+    """
+    def __init__(self, cell_idx, region_idx, regions, cell_ids):
+        self.cell_ids = pd.Index(cell_ids)
 
-    cn_transitions_matrix = (
-        cell_region_counts
-            .stack().rename('pair_cell_count')
-            .rename_axis(index=['region_index_1', 'region_index_2'])
-            .reset_index())
+        # Renumber regions in sorted order
+        order = np.lexsort((regions['start'].values, regions['chr'].astype(str).values))
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order), dtype=np.int32)
 
-    cn_transitions_matrix['pair_cell_count'] = cn_transitions_matrix['pair_cell_count'].astype(int)
+        self.regions = regions.iloc[order].reset_index(drop=True)
+        self.regions.index.name = 'region_index'
 
-    return cn_transitions_matrix
+        self.region_cells = scipy.sparse.csr_matrix(
+            (np.ones(len(cell_idx), dtype=np.int8), (rank[region_idx], cell_idx)),
+            shape=(len(self.regions), len(self.cell_ids)))
+        self.region_cells.sum_duplicates()
+        self.region_cells.data[:] = 1
+
+        self.regions['cell_count'] = np.diff(self.region_cells.indptr)
+
+        # Contiguous block of regions for each chromosome
+        self._starts = self.regions['start'].values
+        self._ends = self.regions['end'].values
+        self._chr_blocks = {}
+        chrs = self.regions['chr'].astype(str).values
+        chr_bounds = np.flatnonzero(np.concatenate([[True], chrs[1:] != chrs[:-1], [True]]))
+        for block_start, block_end in zip(chr_bounds[:-1], chr_bounds[1:]):
+            max_width = (self._ends[block_start:block_end] - self._starts[block_start:block_end]).max()
+            self._chr_blocks[chrs[block_start]] = (block_start, block_end, max_width)
+
+    @classmethod
+    def from_anndata(cls, adata, layer_name='state', chunk_size=None):
+        """ Build a transition index from copy number data.
+
+        Args:
+            adata (AnnData): copy number data with chr, start and end in var
+            layer_name (str, optional): layer with copy number states, None for X. Defaults to 'state'.
+            chunk_size (int, optional): number of cells to process at a time. Defaults to None.
+
+        Returns:
+            TransitionIndex: index of transitions in adata
+
+        """
+        cell_idx, region_idx, regions = cn_transition_regions(adata, layer_name=layer_name, chunk_size=chunk_size)
+        return cls(cell_idx, region_idx, regions, adata.obs.index)
+
+    def _window_indices(self, chromosome, start, end):
+        """ Indices of regions overlapping each of a set of windows on one chromosome.
+
+        Returns pairs of window index and region index.
+        """
+        start = np.atleast_1d(np.asarray(start))
+        end = np.atleast_1d(np.asarray(end))
+
+        if chromosome not in self._chr_blocks:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        block_start, block_end, max_width = self._chr_blocks[chromosome]
+        starts = self._starts[block_start:block_end]
+        ends = self._ends[block_start:block_end]
+
+        # Candidate regions start no earlier than the longest region before the window
+        lo = np.searchsorted(starts, start - max_width, side='left')
+        hi = np.searchsorted(starts, end, side='right')
+
+        window_idx = np.repeat(np.arange(len(start)), hi - lo)
+        offsets = np.arange(window_idx.shape[0]) - np.repeat(np.cumsum(hi - lo) - (hi - lo), hi - lo)
+        region_idx = np.repeat(lo, hi - lo) + offsets
+
+        overlaps = ends[region_idx] >= start[window_idx]
+
+        return window_idx[overlaps], region_idx[overlaps] + block_start
+
+    def query_window(self, chromosome, start, end):
+        """ Transition regions overlapping a window.
+
+        Args:
+            chromosome (str): chromosome
+            start (int): window start
+            end (int): window end
+
+        Returns:
+            DataFrame: regions with chr, start, end, orientation and cell_count
+
+        """
+        _, region_idx = self._window_indices(chromosome, start, end)
+        return self.regions.iloc[region_idx]
+
+    def cells_in_window(self, chromosome, start, end):
+        """ Cells with a transition in a window.
+
+        Args:
+            chromosome (str): chromosome
+            start (int): window start
+            end (int): window end
+
+        Returns:
+            Index: ids of cells with a transition overlapping the window
+
+        """
+        _, region_idx = self._window_indices(chromosome, start, end)
+        cell_idx = np.unique(self.region_cells[region_idx].indices)
+        return self.cell_ids[cell_idx]
+
+    def nearest(self, chromosome, positions, cell_id=None):
+        """ Nearest transition region to each of a set of positions.
+
+        Args:
+            chromosome (str): chromosome
+            positions (int or array): query positions
+            cell_id (str, optional): restrict to transitions of one cell. Defaults to None.
+
+        Returns:
+            DataFrame: nearest region for each position with position and distance columns,
+                distance is 0 for positions within a region, regions missing if the
+                chromosome has no transitions
+
+        """
+        positions = np.atleast_1d(np.asarray(positions))
+
+        if chromosome not in self._chr_blocks:
+            return self.regions.iloc[[]].assign(position=[], distance=[])
+
+        block_start, block_end, _ = self._chr_blocks[chromosome]
+        candidates = np.arange(block_start, block_end)
+
+        if cell_id is not None:
+            cell_idx = self.cell_ids.get_loc(cell_id)
+            has_cell = self.region_cells[block_start:block_end, cell_idx].toarray()[:, 0] > 0
+            candidates = candidates[has_cell]
+            if len(candidates) == 0:
+                return self.regions.iloc[[]].assign(position=[], distance=[])
+
+        starts = self._starts[candidates]
+        ends = self._ends[candidates]
+
+        # Of regions starting before each position, the one extending furthest
+        ends_max = np.maximum.accumulate(ends)
+        furthest = np.maximum.accumulate(np.where(ends == ends_max, np.arange(len(ends)), 0))
+
+        # Compare the closest regions starting before and after each position
+        right = np.searchsorted(starts, positions, side='right')
+        left = furthest[np.clip(right - 1, 0, len(candidates) - 1)]
+        right = np.clip(right, 0, len(candidates) - 1)
+
+        left_distance = np.maximum(positions - ends[left], 0)
+        left_distance[starts[left] > positions] = np.iinfo(np.int64).max
+        right_distance = np.maximum(starts[right] - positions, 0)
+        right_distance[starts[right] <= positions] = np.iinfo(np.int64).max
+
+        is_left = left_distance <= right_distance
+        nearest_idx = np.where(is_left, left, right)
+        distance = np.where(is_left, left_distance, right_distance)
+
+        nearest = self.regions.iloc[candidates[nearest_idx]].copy()
+        nearest['position'] = positions
+        nearest['distance'] = distance
+
+        return nearest
+
+    def join_genes(self, genes, per_cell=False):
+        """ Join transition regions with overlapping genes.
+
+        Args:
+            genes (PyRanges or DataFrame): genes as returned by read_ensemble_genes_gtf,
+                or a DataFrame with chr, start, end and gene_id columns
+            per_cell (bool, optional): one row per cell with a transition in the gene. Defaults to False.
+
+        Returns:
+            DataFrame: gene columns joined to overlapping regions, with cell_id if per_cell
+
+        """
+        if not isinstance(genes, pd.DataFrame):
+            genes = genes.as_df().rename(columns={'Chromosome': 'chr', 'Start': 'start', 'End': 'end'})
+        genes = genes.reset_index(drop=True)
+
+        gene_idx = []
+        region_idx = []
+        for chromosome, chr_genes in genes.groupby(genes['chr'].astype(str), observed=True, sort=False):
+            chr_gene_idx, chr_region_idx = self._window_indices(
+                chromosome, chr_genes['start'].values, chr_genes['end'].values)
+            gene_idx.append(chr_genes.index.values[chr_gene_idx])
+            region_idx.append(chr_region_idx)
+
+        gene_idx = np.concatenate(gene_idx) if gene_idx else np.zeros(0, dtype=int)
+        region_idx = np.concatenate(region_idx) if region_idx else np.zeros(0, dtype=int)
+
+        regions = self.regions.iloc[region_idx].reset_index()
+        joined = pd.concat([
+            genes.iloc[gene_idx].drop(columns=['chr']).rename(
+                columns={'start': 'gene_start', 'end': 'gene_end'}).reset_index(drop=True),
+            regions,
+        ], axis=1)
+
+        if per_cell:
+            region_cells = self.region_cells[region_idx].tocoo()
+            joined = joined.iloc[region_cells.row].reset_index(drop=True)
+            joined['cell_id'] = self.cell_ids[region_cells.col]
+
+        return joined
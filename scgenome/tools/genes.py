@@ -1,69 +1,249 @@
+import os
+import csv
+import hashlib
 import pyranges as pr
 import pandas as pd
 import anndata as ad
 import numpy as np
+import scipy.sparse
 
 from pandas import DataFrame
 from anndata import AnnData
 from pyranges import PyRanges
 from collections.abc import Iterable
+from typing import Dict
 
+import scgenome.tools.getters
 
-def read_ensemble_genes_gtf(gtf_filename) -> PyRanges:
+
+# Gene tables read from gtf files keyed by filename, modification time and size
+_genes_cache = {}
+
+
+def _gtf_cache_key(gtf_filename):
+    stat = os.stat(gtf_filename)
+    return (os.path.abspath(gtf_filename), stat.st_mtime_ns, stat.st_size)
+
+
+def _read_gtf_genes(gtf_filename, chunk_size):
+    """ Stream a gtf and extract gene features with their ids and names.
+    """
+    genes = []
+    for chunk in pd.read_csv(
+            gtf_filename, sep='\t', comment='#', header=None,
+            usecols=[0, 2, 3, 4, 8], names=['Chromosome', 'Feature', 'Start', 'End', 'Attributes'],
+            dtype={'Chromosome': str, 'Feature': str, 'Start': np.int64, 'End': np.int64, 'Attributes': str},
+            quoting=csv.QUOTE_NONE, chunksize=chunk_size):
+        chunk = chunk[chunk['Feature'] == 'gene']
+        genes.append(pd.DataFrame({
+            'Chromosome': chunk['Chromosome'].values,
+            'Start': chunk['Start'].values - 1,
+            'End': chunk['End'].values,
+            'gene_id': chunk['Attributes'].str.extract(r'gene_id "([^"]*)"', expand=False).values,
+            'gene_name': chunk['Attributes'].str.extract(r'gene_name "([^"]*)"', expand=False).values,
+        }))
+
+    genes = pd.concat(genes, ignore_index=True)
+    genes = genes.dropna(subset=['gene_id', 'gene_name']).reset_index(drop=True)
+    genes['Chromosome'] = genes['Chromosome'].astype('category')
+
+    return genes
+
+
+def read_ensemble_genes_gtf(gtf_filename, cache: bool=True, cache_dir: str=None, chunk_size: int=100000) -> PyRanges:
     """ Read an ensembl gtf and extract gene start end
 
+    The gtf is streamed and only gene features are retained, genes without
+    a gene name are removed.  Gene tables are cached in memory, and optionally
+    on disk, keyed by the gtf filename, modification time and size.
+
     Parameters
     ----------
     gtf_filename : str
         GTF filename
+    cache : bool, optional
+        retrieve from and store in the cache, by default True
+    cache_dir : str, optional
+        directory in which to cache gene tables on disk, by default None, memory only
+    chunk_size : int, optional
+        number of gtf lines to parse at a time, by default 100000
 
     Returns
     -------
     PyRanges
         Genes bounds
-    """    
-    genes = pr.read_gtf(gtf_filename, as_df=True)
-    genes = genes.groupby(['Chromosome', 'gene_id', 'gene_name'], observed=True).agg({'Start': min, 'End': max}).reset_index()
-    genes = pr.PyRanges(genes)
-    return genes
+    """
+    key = _gtf_cache_key(gtf_filename)
 
+    if cache and key in _genes_cache:
+        return pr.PyRanges(_genes_cache[key].copy())
 
-def _segment_width_weighted_mean_matrix(data: DataFrame, intersect: DataFrame) -> DataFrame:
-    # Add gene id to index
-    data = data.loc[:, intersect['bin']].T.set_index(pd.Index(intersect['gene_id'].values, name='gene_id'), append=True)
+    cache_filename = None
+    if cache and cache_dir is not None:
+        key_hash = hashlib.md5(repr(key).encode()).hexdigest()
+        cache_filename = os.path.join(cache_dir, f'genes_{key_hash}.pickle')
 
-    # Scale by overlap segment width
-    data = data * intersect['segment_width'].values[:, np.newaxis]
+    if cache_filename is not None and os.path.exists(cache_filename):
+        genes = pd.read_pickle(cache_filename)
 
-    # Calculate segment width normalized mean
-    data = data.groupby(level=1).sum()
-    data = data.T / intersect.groupby('gene_id')['segment_width'].sum()
+    else:
+        genes = _read_gtf_genes(gtf_filename, chunk_size)
 
-    return data
+        if cache_filename is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            genes.to_pickle(cache_filename)
+
+    if cache:
+        _genes_cache[key] = genes
 
+    return pr.PyRanges(genes.copy())
 
-def _segment_width_weighted_mean_var(data: DataFrame, intersect: DataFrame) -> DataFrame:
-    # Add gene id to index
-    data = data.loc[intersect['bin']].set_index(pd.Index(intersect['gene_id'].values, name='gene_id'), append=True)
 
-    # Scale by overlap segment width
-    data = data * intersect['segment_width'].values[:, np.newaxis]
+def bin_gene_weights(adata: AnnData, genes: PyRanges):
+    """ Compute overlap widths between bins and genes as a sparse matrix
 
-    # Calculate segment width normalized mean
-    data = data.groupby(level=1).sum()
-    data = (data.T / intersect.groupby('gene_id')['segment_width'].sum()).T
+    The result can be computed once and passed to `aggregate_genes` and
+    `aggregate_gene_sets` for any AnnData with the same bins.
 
+    Parameters
+    ----------
+    adata : AnnData
+        copy number data with chr, start and end in var
+    genes : PyRanges
+        gene data
+
+    Returns
+    -------
+    tuple
+        bins by genes csr matrix of overlap widths, and Index of gene ids of
+        genes overlapping bins, sorted
+    """
+    var = adata.var
+
+    bins = pr.PyRanges(pd.DataFrame({
+        'Chromosome': var['chr'].values,
+        'Start': var['start'].values,
+        'End': var['end'].values,
+        'bin_idx': np.arange(var.shape[0]),
+    }))
+
+    genes = pr.PyRanges(genes.as_df()[['Chromosome', 'Start', 'End', 'gene_id']])
+
+    overlaps = bins.join(genes, suffix='_gene').as_df()
+    overlaps['segment_width'] = (
+        np.minimum(overlaps['End'], overlaps['End_gene']) -
+        np.maximum(overlaps['Start'], overlaps['Start_gene']))
+    overlaps = overlaps[overlaps['segment_width'] > 0]
+
+    gene_idx, gene_ids = pd.factorize(overlaps['gene_id'], sort=True)
+
+    weights = scipy.sparse.csr_matrix(
+        (overlaps['segment_width'].values.astype(float), (overlaps['bin_idx'].values, gene_idx)),
+        shape=(var.shape[0], len(gene_ids)))
+
+    return weights, pd.Index(gene_ids, name='gene_id')
+
+
+def _weighted_mean_matrix(data, weights, weight_sums, dtype):
+    """ Weighted mean of the bins of each row of data, ignoring nan.
+
+    Weighted means are computed as (X0 @ W) / (P @ W) for X0 the data
+    with nan set to 0 and P indicating non-nan entries.
+    """
+    if scipy.sparse.issparse(data):
+        data = scipy.sparse.csr_matrix(data, dtype=dtype, copy=True)
+        is_nan = np.isnan(data.data)
+        has_nan = is_nan.any()
+        if has_nan:
+            missing = scipy.sparse.csr_matrix((is_nan.astype(dtype), data.indices, data.indptr), shape=data.shape)
+            data.data[is_nan] = 0
+
+    else:
+        data = np.array(data, dtype=dtype)
+        is_nan = np.isnan(data)
+        has_nan = is_nan.any()
+        if has_nan:
+            missing = is_nan.astype(dtype)
+            data[is_nan] = 0
+
+    sums = data @ weights
+    if scipy.sparse.issparse(sums):
+        sums = sums.toarray()
+
+    if has_nan:
+        missing_weight_sums = missing @ weights
+        if scipy.sparse.issparse(missing_weight_sums):
+            missing_weight_sums = missing_weight_sums.toarray()
+        present_weight_sums = weight_sums - missing_weight_sums
+    else:
+        present_weight_sums = weight_sums[np.newaxis, :]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / present_weight_sums
+
+    np.copyto(means, np.nan, where=present_weight_sums == 0)
+
+    return means
+
+
+def _aggregate_layer_genes(adata, layer_name, bin_idx, weights, weight_sums, dtype, chunk_size):
+    """ Weighted mean of a layer for each gene, computed in chunks of cells.
+    """
+    data = np.zeros((adata.shape[0], weights.shape[1]), dtype=dtype)
+    for cells, chunk in scgenome.tools.getters.iter_layer_chunks(adata, layer_name, chunk_size=chunk_size):
+        data[cells] = _weighted_mean_matrix(chunk[:, bin_idx], weights, weight_sums, dtype)
     return data
 
 
+def _select_gene_weights(weights, gene_ids, genes: PyRanges, select_genes: Iterable):
+    """ Subset the weights to the requested genes, given as gene ids or gene names.
+    """
+    select_genes = pd.Index(select_genes)
+
+    gene_names = genes.as_df().drop_duplicates('gene_id').set_index('gene_id')['gene_name']
+    name_to_id = pd.Series(gene_names.index, index=gene_names.values)
+    name_to_id = name_to_id[~name_to_id.index.duplicated()]
+
+    select_ids = select_genes.where(select_genes.isin(gene_ids), select_genes.map(name_to_id))
+
+    gene_idx = gene_ids.get_indexer(select_ids.dropna().unique())
+    gene_idx = gene_idx[gene_idx >= 0]
+
+    return weights.tocsc()[:, gene_idx].tocsr(), gene_ids[gene_idx]
+
+
+def _prepare_gene_weights(adata, genes, weights, select_genes, dtype):
+    if weights is None:
+        weights = bin_gene_weights(adata, genes)
+    weights, gene_ids = weights
+
+    if select_genes is not None:
+        weights, gene_ids = _select_gene_weights(weights, gene_ids, genes, select_genes)
+
+    # Restrict to bins overlapping a gene
+    bin_idx = np.flatnonzero(weights.getnnz(axis=1))
+    weights = weights[bin_idx]
+
+    weight_sums = np.asarray(weights.sum(axis=0))[0]
+
+    return bin_idx, weights.astype(dtype), weight_sums.astype(dtype), gene_ids
+
+
 def aggregate_genes(
         adata: AnnData,
         genes: PyRanges,
         agg_layers: Iterable=None,
-        agg_var: Iterable=None) -> AnnData:
+        agg_var: Iterable=None,
+        dtype=np.float64,
+        chunk_size: int=None,
+        select_genes: Iterable=None,
+        weights=None) -> AnnData:
     """ Aggregate copy number by gene to create gene CN matrix
 
-    Currently only does segment width weighted mean aggregation.
+    Currently only does segment width weighted mean aggregation.  Overlap widths
+    of bins and genes are computed once as a sparse bin by gene matrix that is
+    applied to X and each layer.  Missing values are ignored, and genes with no
+    overlapping non-missing bins are nan.
 
     Parameters
     ----------
@@ -75,13 +255,26 @@ def aggregate_genes(
         list of layers to aggregate, by default None, all layers
     agg_var : List, optional
         list of obs columns to aggregate, by default None, all columns
-    cluster_col : str, optional
-        column with cluster ids, by default 'cluster_id'
+    dtype : dtype, optional
+        dtype of the gene copy number, for instance np.float32 to halve memory, by default np.float64
+    chunk_size : int, optional
+        number of cells to aggregate at a time, by default None
+    select_genes : List, optional
+        gene ids or gene names of a subset of genes to aggregate, by default None, all genes
+    weights : tuple, optional
+        bin gene weights precomputed with `bin_gene_weights`, by default None
 
     Returns
     -------
     AnnData
         aggregated gene copy number
+
+    Examples
+    -------
+
+    >>> weights = scgenome.tl.bin_gene_weights(adata, genes)
+    >>> gene_adata = scgenome.tl.aggregate_genes(adata, genes, select_genes=['TP53', 'BRCA1'], weights=weights)
+
     """
 
     if agg_layers is None:
@@ -90,27 +283,19 @@ def aggregate_genes(
 
     if agg_var is None:
         agg_var = set(adata.var.select_dtypes(include=np.number).columns.to_list()) - set(['chr', 'start', 'end'])
-    agg_var = set(agg_var)
-
-    bins = pr.PyRanges(adata.var.reset_index().rename(columns={
-        'chr': 'Chromosome',
-        'start': 'Start',
-        'end': 'End',
-    })[['Chromosome', 'Start', 'End', 'bin']])
-
-    intersect_1 = genes.intersect(bins)
-    intersect_2 = bins.intersect(genes)
+    agg_var = list(agg_var)
 
-    intersect = pd.merge(intersect_1.as_df(), intersect_2.as_df())
-    intersect['segment_width'] = intersect['End'] - intersect['Start']
+    bin_idx, weights, weight_sums, gene_ids = _prepare_gene_weights(adata, genes, weights, select_genes, dtype)
 
-    X = _segment_width_weighted_mean_matrix(adata.to_df(), intersect)
+    X = _aggregate_layer_genes(adata, None, bin_idx, weights, weight_sums, dtype, chunk_size)
 
     layer_data = {}
     for layer_name in agg_layers:
-        layer_data[layer_name] = _segment_width_weighted_mean_matrix(adata.to_df(layer=layer_name), intersect)
+        layer_data[layer_name] = _aggregate_layer_genes(adata, layer_name, bin_idx, weights, weight_sums, dtype, chunk_size)
 
-    var = _segment_width_weighted_mean_var(adata.var[agg_var], intersect)
+    var = pd.DataFrame(
+        _weighted_mean_matrix(adata.var[agg_var].values[bin_idx].T, weights, weight_sums, np.float64).T,
+        index=gene_ids, columns=agg_var)
 
     gene_data = genes.as_df().drop_duplicates().set_index('gene_id')
     var = var.merge(gene_data, left_index=True, right_index=True, how='left')
@@ -125,3 +310,89 @@ def aggregate_genes(
     return adata
 
 
+def aggregate_gene_sets(
+        adata: AnnData,
+        genes: PyRanges,
+        gene_sets: Dict[str, Iterable],
+        agg_layers: Iterable=None,
+        dtype=np.float64,
+        chunk_size: int=None,
+        weights=None) -> AnnData:
+    """ Aggregate copy number by gene set to create a gene set CN matrix
+
+    Gene copy number is computed only for genes in the gene sets, as a segment
+    width weighted mean, and averaged across the genes of each set ignoring
+    genes with missing copy number.
+
+    Parameters
+    ----------
+    adata : AnnData
+        copy number data
+    genes : PyRanges
+        gene data
+    gene_sets : dict
+        gene ids or gene names of each gene set keyed by gene set name
+    agg_layers : List, optional
+        list of layers to aggregate, by default None, all layers
+    dtype : dtype, optional
+        dtype of the gene set copy number, by default np.float64
+    chunk_size : int, optional
+        number of cells to aggregate at a time, by default None
+    weights : tuple, optional
+        bin gene weights precomputed with `bin_gene_weights`, by default None
+
+    Returns
+    -------
+    AnnData
+        aggregated gene set copy number, with the number of genes of
+        each set found in the gene data in var
+    """
+
+    if agg_layers is None:
+        agg_layers = adata.layers.keys()
+
+    if len(gene_sets) == 0:
+        raise ValueError('gene_sets is empty, expected at least one gene set')
+
+    select_genes = pd.Index(np.concatenate([list(a) for a in gene_sets.values()])).unique()
+    if len(select_genes) == 0:
+        raise ValueError('gene_sets contain no genes')
+
+    gene_adata = aggregate_genes(
+        adata, genes, agg_layers=agg_layers, agg_var=[], dtype=dtype,
+        chunk_size=chunk_size, select_genes=select_genes, weights=weights)
+
+    # Gene set by gene indicator matrix, genes matched by id or name
+    set_names = list(gene_sets.keys())
+    set_idx = []
+    gene_idx = []
+    for idx, set_name in enumerate(set_names):
+        set_genes = pd.Index(gene_sets[set_name])
+        is_member = gene_adata.var.index.isin(set_genes) | gene_adata.var['gene_name'].isin(set_genes)
+        member_idx = np.flatnonzero(is_member)
+        set_idx.append(np.full(len(member_idx), idx))
+        gene_idx.append(member_idx)
+    set_idx = np.concatenate(set_idx)
+    gene_idx = np.concatenate(gene_idx)
+
+    membership = scipy.sparse.csr_matrix(
+        (np.ones(len(set_idx), dtype=dtype), (gene_idx, set_idx)),
+        shape=(gene_adata.shape[1], len(set_names)))
+    membership_sums = np.asarray(membership.sum(axis=0))[0]
+
+    X = _weighted_mean_matrix(gene_adata.X, membership, membership_sums, dtype)
+
+    layer_data = {}
+    for layer_name in agg_layers:
+        layer_data[layer_name] = _weighted_mean_matrix(gene_adata.layers[layer_name], membership, membership_sums, dtype)
+
+    var = pd.DataFrame({'n_genes': membership_sums.astype(int)}, index=pd.Index(set_names, name='gene_set'))
+
+    adata = ad.AnnData(
+        X,
+        obs=adata.obs,
+        var=var,
+        layers=layer_data,
+    )
+
+    return adata
@@ -1,5 +1,35 @@
+import collections
+import zlib
+import numpy as np
+import scipy.sparse
+import sklearn.preprocessing
+import pandas as pd
+
 from anndata import AnnData
 from pandas import DataFrame
+from collections.abc import Iterable
+from typing import Union
+
+import scgenome.preprocessing.transform
+
+
+# Number of cells read or processed at a time by chunked and backed operations
+default_chunk_size = 1000
+
+# Maximum total size in bytes of feature matrices cached per anndata, 0 to
+# disable caching
+feature_cache_max_bytes = 256 * 1024 * 1024
+
+# Attribute of the anndata in which feature matrices are cached
+_feature_cache_attr = '_scgenome_feature_cache'
+
+
+class _FeatureCache(collections.OrderedDict):
+    """ Cached feature matrices of an anndata, least recently used first, not
+    pickled with the anndata.
+    """
+    def __reduce__(self):
+        return (type(self), ())
 
 
 def get_obs_data(
@@ -45,3 +75,277 @@ def get_obs_data(
     
     return data
 
+
+def get_layer_matrix(
+        adata: AnnData,
+        layer_name: Union[None, str, Iterable[Union[None,str]]]=None,
+        cell_ids: Iterable[str]=None,
+        bin_ids: Iterable[str]=None):
+    """ Get the matrix for a layer or a set of layers concatenated across bins
+
+    Sparse layers are returned as sparse matrices and are not densified.  For
+    backed anndata, the requested cells and bins of X are read into memory.
+
+    Parameters
+    ----------
+    adata : AnnData
+        anndata from which to retrieve layer data
+    layer_name : str or list, optional
+        layer or list of layers, None for X, by default None
+    cell_ids : list, optional
+        subset of cells, by default None, all cells
+    bin_ids : list, optional
+        subset of bins, by default None, all bins
+
+    Returns
+    -------
+    ndarray or sparse matrix
+        copy of the cells by bins matrix, bins of multiple layers concatenated
+    """
+    if cell_ids is not None or bin_ids is not None:
+        adata = adata[
+            cell_ids if cell_ids is not None else slice(None),
+            bin_ids if bin_ids is not None else slice(None)]
+
+    def __get_layer(layer_name, copy):
+        if layer_name is not None:
+            data = adata.layers[layer_name]
+        else:
+            data = adata.X
+        if scipy.sparse.issparse(data):
+            return scipy.sparse.csr_matrix(data, copy=copy)
+        if copy:
+            return np.array(data)
+        return np.asarray(data)
+
+    if isinstance(layer_name, (str, type(None))):
+        return __get_layer(layer_name, True)
+
+    elif isinstance(layer_name, Iterable):
+        layers = [__get_layer(l, False) for l in layer_name]
+        if any(scipy.sparse.issparse(l) for l in layers):
+            return scipy.sparse.hstack(layers, format='csr')
+        return np.concatenate(layers, axis=1)
+
+    else:
+        raise ValueError(f'layer_name was {layer_name}')
+
+
+def chunk_ranges(n: int, chunk_size: int=None):
+    """ Generate start and end of consecutive chunks
+
+    Parameters
+    ----------
+    n : int
+        total size
+    chunk_size : int, optional
+        size of each chunk, by default None, a single chunk
+
+    Yields
+    ------
+    tuple
+        start and end of each chunk
+    """
+    if chunk_size is None:
+        chunk_size = max(n, 1)
+
+    for start in range(0, n, chunk_size):
+        yield start, min(start + chunk_size, n)
+
+
+def iter_layer_chunks(
+        adata: AnnData,
+        layer_name: str=None,
+        chunk_size: int=None):
+    """ Iterate over chunks of cells of a layer
+
+    For backed anndata, X is read from disk one chunk at a time.  Sparse
+    layers yield sparse chunks.
+
+    Parameters
+    ----------
+    adata : AnnData
+        anndata from which to retrieve layer data, possibly backed
+    layer_name : str, optional
+        layer name, None for X, by default None
+    chunk_size : int, optional
+        number of cells per chunk, by default None, `default_chunk_size`
+
+    Yields
+    ------
+    tuple
+        slice of cells and cells by bins matrix for the chunk
+    """
+    if chunk_size is None:
+        chunk_size = default_chunk_size
+
+    if layer_name is not None:
+        data = adata.layers[layer_name]
+    else:
+        data = adata.X
+
+    for start, end in chunk_ranges(adata.shape[0], chunk_size):
+        chunk = data[start:end]
+        if scipy.sparse.issparse(chunk):
+            chunk = scipy.sparse.csr_matrix(chunk)
+        else:
+            chunk = np.asarray(chunk)
+        yield slice(start, end), chunk
+
+
+def _layer_names(layer_name):
+    if isinstance(layer_name, (str, type(None))):
+        return (layer_name,)
+    return tuple(layer_name)
+
+
+def _layer_checksum(data):
+    """ Shape, dtype and checksum of the values of a dense or sparse layer
+    """
+    if scipy.sparse.issparse(data):
+        arrays = (data.data, data.indices, data.indptr)
+    else:
+        arrays = (data,)
+    checksum = 0
+    for values in arrays:
+        values = np.ascontiguousarray(values)
+        checksum = zlib.crc32(memoryview(values.reshape(-1).view(np.uint8)), checksum)
+    return (data.shape, str(data.dtype), checksum)
+
+
+def _layer_fingerprint(adata: AnnData, layer_names):
+    """ Checksums of the layers, None for backed anndata which is not cached
+    """
+    if adata.isbacked:
+        return None
+    fingerprint = []
+    for layer_name in layer_names:
+        data = adata.layers[layer_name] if layer_name is not None else adata.X
+        if not isinstance(data, np.ndarray) and not scipy.sparse.issparse(data):
+            return None
+        fingerprint.append(_layer_checksum(data))
+    return tuple(fingerprint)
+
+
+def _ids_key(ids, index):
+    """ Key for a subset of ids, None for all ids in order
+    """
+    if ids is None:
+        return None
+    ids = pd.Index(ids)
+    if ids.equals(index):
+        return None
+    return hash(tuple(str(a) for a in ids))
+
+
+def _matrix_nbytes(X):
+    if scipy.sparse.issparse(X):
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return X.nbytes
+
+
+def _set_readonly(X):
+    arrays = (X.data, X.indices, X.indptr) if scipy.sparse.issparse(X) else (X,)
+    for values in arrays:
+        values.flags.writeable = False
+
+
+def get_feature_matrix(
+        adata: AnnData,
+        layer_name: Union[None, str, Iterable[Union[None,str]]]='copy',
+        cell_ids: Iterable[str]=None,
+        bin_ids: Iterable[str]=None,
+        standardize: bool=False,
+        cache: bool=True,
+        use_rep: str=None):
+    """ Get a feature matrix with missing values filled, optionally standardized
+
+    Feature matrices are cached on the anndata keyed by layer names, cell
+    and bin subsets and standardization.  Cell and bin ids matching the full
+    index are equivalent to None.  Cached matrices are validated against a
+    checksum of the layers, and rebuilt if the layers have been replaced or
+    modified inplace.  At most `feature_cache_max_bytes` are cached per
+    anndata, least recently used matrices are evicted first and larger
+    matrices are not cached.  Backed anndata is not cached.  Cached matrices
+    are shared and read only.
+
+    Sparse layers are densified when standardizing, such that features are
+    centered as for dense layers.
+
+    Parameters
+    ----------
+    adata : AnnData
+        anndata from which to retrieve layer data
+    layer_name : str or list, optional
+        layer or list of layers, None for X, by default 'copy'
+    cell_ids : list, optional
+        subset of cells, by default None, all cells
+    bin_ids : list, optional
+        subset of bins, by default None, all bins
+    standardize : bool, optional
+        standardize each feature, by default False
+    cache : bool, optional
+        retrieve from and store in the cache, by default True
+    use_rep : str, optional
+        use a cell embedding in obsm such as 'X_pca' instead of layers, by default None
+
+    Returns
+    -------
+    ndarray or sparse matrix
+        cells by features matrix with missing values filled
+    """
+    if use_rep is not None:
+        X = np.asarray(adata.obsm[use_rep])
+        if cell_ids is not None:
+            cell_idx = adata.obs.index.get_indexer(cell_ids)
+            if (cell_idx < 0).any():
+                missing = list(pd.Index(cell_ids)[cell_idx < 0])
+                raise KeyError(f'cells not in adata: {missing}')
+            X = X[cell_idx]
+        if standardize:
+            X = sklearn.preprocessing.StandardScaler().fit_transform(X)
+        return X
+
+    layer_names = _layer_names(layer_name)
+    key = (layer_names, _ids_key(cell_ids, adata.obs.index), _ids_key(bin_ids, adata.var.index), standardize)
+
+    fingerprint = _layer_fingerprint(adata, layer_names) if cache else None
+
+    entries = getattr(adata, _feature_cache_attr, None)
+    if fingerprint is not None and entries is not None and key in entries:
+        cached_fingerprint, X, _ = entries[key]
+        if cached_fingerprint == fingerprint:
+            entries.move_to_end(key)
+            return X
+
+    X = get_layer_matrix(adata, layer_name, cell_ids=cell_ids, bin_ids=bin_ids)
+
+    X = scgenome.preprocessing.transform.fill_missing(X, inplace=True)
+
+    if standardize:
+        if scipy.sparse.issparse(X):
+            X = X.toarray()
+        X = sklearn.preprocessing.StandardScaler().fit_transform(X)
+
+    nbytes = _matrix_nbytes(X)
+    if fingerprint is not None and nbytes <= feature_cache_max_bytes:
+        if entries is None:
+            entries = _FeatureCache()
+            setattr(adata, _feature_cache_attr, entries)
+        _set_readonly(X)
+        entries[key] = (fingerprint, X, nbytes)
+        while sum(entry[2] for entry in entries.values()) > feature_cache_max_bytes:
+            entries.popitem(last=False)
+
+    return X
+
+
+def clear_feature_cache(adata: AnnData):
+    """ Clear cached feature matrices of an anndata
+
+    Parameters
+    ----------
+    adata : AnnData
+        anndata for which to clear cached feature matrices
+    """
+    adata.__dict__.pop(_feature_cache_attr, None)
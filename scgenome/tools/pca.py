@@ -3,15 +3,102 @@ import sklearn.preprocessing
 import pandas as pd
 import anndata as ad
 import numpy as np
+import scipy.sparse
 
 import scgenome.preprocessing.transform
+import scgenome.tools.getters
 
 from anndata import AnnData
 
 
-def pca_loadings(adata: AnnData, layer=None, n_components=None, random_state=100) -> AnnData:
+def _standardized_chunks(adata: AnnData, layer, chunk_size):
+    """ Generate chunks of cells filled with bin means and standardized
+    """
+    n_cells = adata.shape[0]
+
+    # Bin statistics ignoring nan
+    sums = 0.
+    sum_squares = 0.
+    counts = 0.
+    for _, chunk in scgenome.tools.getters.iter_layer_chunks(adata, layer, chunk_size=chunk_size):
+        if scipy.sparse.issparse(chunk):
+            chunk = chunk.toarray()
+        is_present = ~np.isnan(chunk)
+        sums = sums + np.sum(chunk, axis=0, where=is_present, dtype=np.float64)
+        sum_squares = sum_squares + np.sum(np.square(chunk, dtype=np.float64), axis=0, where=is_present)
+        counts = counts + is_present.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    means[counts == 0] = 0
+
+    # Filling with bin means retains the mean, filled entries add no variance
+    variances = (sum_squares - counts * means ** 2) / n_cells
+    scales = np.sqrt(np.maximum(variances, 0))
+    scales[scales == 0] = 1.
+
+    def __iter_chunks():
+        for cells, chunk in scgenome.tools.getters.iter_layer_chunks(adata, layer, chunk_size=chunk_size):
+            if scipy.sparse.issparse(chunk):
+                chunk = chunk.toarray()
+            chunk = np.array(chunk, dtype=np.float64)
+            np.copyto(chunk, np.broadcast_to(means, chunk.shape), where=np.isnan(chunk))
+            chunk -= means
+            chunk /= scales
+            yield cells, chunk
+
+    return __iter_chunks
+
+
+def _incremental_pca(adata: AnnData, layer, n_components, chunk_size):
+    """ Incremental PCA reading and standardizing chunks of cells
+    """
+    if chunk_size is None:
+        chunk_size = scgenome.tools.getters.default_chunk_size
+
+    # Each partial fit requires at least n_components cells
+    if n_components is not None:
+        chunk_size = max(chunk_size, n_components)
+
+    iter_chunks = _standardized_chunks(adata, layer, chunk_size)
+
+    pca = sklearn.decomposition.IncrementalPCA(n_components=n_components)
+
+    # Merge a small final chunk with the previous chunk
+    previous = None
+    for _, chunk in iter_chunks():
+        if previous is not None:
+            if chunk.shape[0] < chunk_size:
+                chunk = np.concatenate([previous, chunk])
+            else:
+                pca.partial_fit(previous)
+        previous = chunk
+    pca.partial_fit(previous)
+
+    transformed = np.zeros((adata.shape[0], pca.n_components_))
+    for cells, chunk in iter_chunks():
+        transformed[cells] = pca.transform(chunk)
+
+    return pca, transformed
+
+
+def pca_loadings(
+        adata: AnnData,
+        layer=None,
+        n_components=None,
+        random_state=100,
+        solver='auto',
+        chunk_size=None,
+        store_embedding=False,
+        key_added='pca',
+    ) -> AnnData:
     """ Compute PCA loadings matrix
 
+    Sparse layers are decomposed without densifying if `n_components` is
+    less than the number of cells and bins.  The 'incremental' solver reads,
+    fills and standardizes chunks of cells, bounding memory to the size of
+    a chunk, and supports backed anndata.
+
     Parameters
     ----------
     adata : AnnData
@@ -22,6 +109,19 @@ def pca_loadings(adata: AnnData, layer=None, n_components=None, random_state=100
         sklearn.decomposition.PCA n_components parameter, by default None
     random_state : int, optional
         sklearn.decomposition.PCA random_state parameter, by default 100
+    solver : str, optional
+        'incremental' for sklearn.decomposition.IncrementalPCA on chunks of cells,
+        otherwise the sklearn.decomposition.PCA svd_solver parameter, for example
+        'randomized' for randomized SVD, by default 'auto'
+    chunk_size : int, optional
+        number of cells per chunk for the 'incremental' solver, by default None,
+        `scgenome.tools.getters.default_chunk_size`
+    store_embedding : bool, optional
+        store the cell embedding in adata.obsm['X_<key_added>'], the loadings in
+        adata.varm['<key_added>_loadings'] and parameters and explained variance
+        in adata.uns['<key_added>'] of the input anndata, by default False
+    key_added : str, optional
+        key for the stored embedding, by default 'pca'
 
     Returns
     -------
@@ -35,14 +135,26 @@ def pca_loadings(adata: AnnData, layer=None, n_components=None, random_state=100
         adata (anndata.AnnData): feature matrix
     """
 
-    if layer is None:
-        data = adata.X
+    if solver == 'incremental':
+        pca, transformed = _incremental_pca(adata, layer, n_components, chunk_size)
+        n_samples = pca.n_samples_seen_
+
     else:
-        data = adata.layers[layer]
+        # Sparse data is scaled but not centered, PCA centers sparse data implicitly
+        data = scgenome.tools.getters.get_feature_matrix(adata, layer, standardize=True)
+
+        if scipy.sparse.issparse(data) and (n_components is None or n_components >= min(data.shape)):
+            # Sparse PCA requires a truncated decomposition
+            data = data.toarray()
 
-    scaler = sklearn.preprocessing.StandardScaler()
-    pca = sklearn.decomposition.PCA(n_components=n_components, random_state=random_state)
-    transformed = pca.fit_transform(scaler.fit_transform(scgenome.preprocessing.transform.fill_missing(data)))
+        if scipy.sparse.issparse(data) and solver in ('auto', 'randomized'):
+            # Randomized SVD is not supported for sparse data
+            solver = 'arpack'
+
+        pca = sklearn.decomposition.PCA(n_components=n_components, svd_solver=solver, random_state=random_state)
+
+        transformed = pca.fit_transform(data)
+        n_samples = pca.n_samples_
 
     var = adata.var.copy()
     var['pca_mean'] = pca.mean_
@@ -59,17 +171,30 @@ def pca_loadings(adata: AnnData, layer=None, n_components=None, random_state=100
         index=adata.obs.index,
         columns=obs.index)
 
+    params = {
+        'layer': layer,
+        'n_components': n_components,
+        'random_state': random_state,
+        'solver': solver,
+        'chunk_size': chunk_size,
+    }
+
+    if store_embedding:
+        adata.obsm['X_' + key_added] = transformed.values
+        adata.varm[key_added + '_loadings'] = pca.components_.T
+        adata.uns[key_added] = {
+            'params': {k: v for k, v in params.items() if v is not None},
+            'explained_variance': pca.explained_variance_,
+            'explained_variance_ratio': pca.explained_variance_ratio_,
+        }
+
     uns = {
         'pca': {
-            'params': {
-                'layer': layer,
-                'n_components': n_components,
-                'random_state': random_state,
-            },
+            'params': params,
             'results': {
                 'n_components': pca.n_components_,
-                'n_features': pca.n_features_,
-                'n_samples': pca.n_samples_,
+                'n_features': pca.n_features_in_,
+                'n_samples': n_samples,
                 'noise_variance': pca.noise_variance_,
                 'n_features_in': pca.n_features_in_,
                 'transformed': transformed,
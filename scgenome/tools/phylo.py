@@ -1,24 +1,720 @@
+import io
+import warnings
+import Bio.Phylo
+import Bio.Phylo.BaseTree
+import numpy as np
+import pandas as pd
+import anndata as ad
+import scipy.sparse
 
+from anndata import AnnData
+from typing import Dict
+
+import scgenome.preprocessing.dtype_policy
+import scgenome.tools.getters
+
+
+def _terminal_names(tree):
+    """ Names of terminals in tree order
+    """
+    return pd.Index([a.name for a in tree.get_terminals()])
+
+
+def get_phylo_order(tree, cell_ids):
+    """ Position of each cell in the order of the terminals of a tree
+
+    Parameters
+    ----------
+    tree : Bio.Phylo.BaseTree.Tree
+        phylogenetic tree
+    cell_ids : list
+        cell ids, for instance adata.obs.index
+
+    Returns
+    -------
+    ndarray
+        position of each cell in the terminal order, -1 for cells not in the tree
+    """
+    return _terminal_names(tree).get_indexer(cell_ids)
 
 
 def prune_leaves(tree, f):
-    while tree.count_terminals() > 0:
-        altered = False
-        for a in tree.get_terminals():
-            if f(a):
-                tree.prune(a)
-                altered = True
-        if not altered:
-            break
+    """ Prune leaves of a tree for which a predicate is true
+
+    Equivalent to repeatedly calling `tree.prune` on terminals for which `f`
+    is true, computed in a single bottom up pass.  Internal nodes left with
+    one child are collapsed into the child, adding their branch length, and
+    unary internal nodes left with no children become terminals to which `f`
+    is also applied.
+
+    Parameters
+    ----------
+    tree : Bio.Phylo.BaseTree.Tree
+        phylogenetic tree, modified inplace
+    f : callable
+        predicate taking a clade, true for leaves to prune
+    """
+    # Clades in preorder, visited in reverse for children before parents
+    clades = []
+    stack = [tree.root]
+    while stack:
+        clade = stack.pop()
+        clades.append(clade)
+        stack.extend(clade.clades)
+
+    # Replacement of each clade after pruning, None if removed
+    pruned = {}
+    for clade in reversed(clades):
+        if not clade.clades:
+            pruned[id(clade)] = None if f(clade) else clade
+            continue
+
+        num_children = len(clade.clades)
+        kept = [pruned.pop(id(child)) for child in clade.clades]
+        kept = [child for child in kept if child is not None]
+
+        if len(kept) >= 2 or (len(kept) == 1 and num_children == 1):
+            clade.clades[:] = kept
+            pruned[id(clade)] = clade
+
+        elif len(kept) == 1:
+            # Collapse into the remaining child
+            child = kept[0]
+            if child.branch_length is not None:
+                child.branch_length += clade.branch_length or 0.0
+            pruned[id(clade)] = child
+
+        elif num_children == 1:
+            # Unary clade becomes a terminal
+            clade.clades[:] = []
+            pruned[id(clade)] = None if f(clade) else clade
+
+        else:
+            pruned[id(clade)] = None
+
+    root = pruned[id(tree.root)]
+    if root is not None:
+        tree.root = root
+    else:
+        tree.root.clades[:] = []
 
 
 def align_cn_tree(tree, adata):
-    prune_leaves(tree, lambda a: a.name not in adata.obs.index)
+    obs_ids = set(adata.obs.index)
+    prune_leaves(tree, lambda a: a.name not in obs_ids)
 
-    cell_ids = []
-    for a in tree.get_terminals():
-        cell_ids.append(a.name)
+    # Reorder by position, adata is a view
+    cell_positions = adata.obs.index.get_indexer(_terminal_names(tree))
 
-    adata = adata[cell_ids]
+    adata = adata[cell_positions]
 
     return tree, adata
+
+
+def _ancestor_sum(parent, values):
+    """ Sum of values over each node and its ancestors, by pointer jumping
+    """
+    total = values.astype(float).copy()
+    ancestor = parent.copy()
+    while (ancestor >= 0).any():
+        has_ancestor = ancestor >= 0
+        total[has_ancestor] += total[ancestor[has_ancestor]]
+        ancestor[has_ancestor] = ancestor[ancestor[has_ancestor]]
+    return total
+
+
+def _nearest_ancestor(parent, is_target):
+    """ Nearest strict ancestor of each node for which is_target is true, -1 if none
+    """
+    ancestor = parent.copy()
+    while True:
+        jump = (ancestor >= 0)
+        jump[jump] = ~is_target[ancestor[jump]]
+        if not jump.any():
+            return ancestor
+        ancestor[jump] = parent[ancestor[jump]]
+
+
+class ArrayTree(object):
+    """ Array backed phylogenetic tree
+
+    Nodes are stored in preorder, such that each clade is a contiguous range
+    of nodes and its leaves a contiguous range of the leaf order, and parents
+    precede their children.
+
+    Parameters
+    ----------
+    parent : ndarray
+        index of the parent of each node in preorder, -1 for the root
+    branch_length : ndarray
+        branch length of each node, nan if missing
+    names : ndarray
+        name of each node, None if missing
+
+    Attributes
+    ----------
+    parent : ndarray
+        index of the parent of each node, -1 for the root
+    branch_length : ndarray
+        branch length of each node, nan if missing
+    names : ndarray
+        name of each node
+    is_leaf : ndarray
+        whether each node is a leaf
+    leaf_order : ndarray
+        node index of leaves in tree order
+    leaf_start : ndarray
+        position in the leaf order of the first leaf of each clade
+    clade_size : ndarray
+        number of leaves of each clade
+    depth : ndarray
+        number of branches between the root and each node
+    """
+    def __init__(self, parent, branch_length, names):
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.branch_length = np.asarray(branch_length, dtype=float)
+        self.names = np.asarray(names, dtype=object)
+
+        n_nodes = len(self.parent)
+        if (n_nodes == 0 or self.parent[0] != -1 or (self.parent[1:] < 0).any() or
+                (self.parent[1:] >= np.arange(1, n_nodes)).any()):
+            raise ValueError('nodes must be in preorder with the root first')
+
+        self.n_children = np.bincount(self.parent[1:], minlength=n_nodes)
+        self.is_leaf = self.n_children == 0
+        self.leaf_order = np.flatnonzero(self.is_leaf)
+        self.leaf_start = np.cumsum(self.is_leaf) - self.is_leaf
+        self.depth = _ancestor_sum(self.parent, np.concatenate([[0], np.ones(n_nodes - 1)])).astype(int)
+
+        # Bottom up leaf and node counts, one depth level at a time
+        self.clade_size = self.is_leaf.astype(int)
+        subtree_size = np.ones(n_nodes, dtype=int)
+        for nodes in self._levels()[:0:-1]:
+            np.add.at(self.clade_size, self.parent[nodes], self.clade_size[nodes])
+            np.add.at(subtree_size, self.parent[nodes], subtree_size[nodes])
+
+        # Depth first preorder, the subtree of each node is contiguous and
+        # within the subtree of its parent
+        subtree_end = np.arange(n_nodes) + subtree_size
+        if (subtree_end[1:] > subtree_end[self.parent[1:]]).any():
+            raise ValueError('nodes must be in depth first preorder')
+
+    def _levels(self):
+        """ Node indices at each depth, from the root
+        """
+        order = np.argsort(self.depth, kind='stable')
+        bounds = np.searchsorted(self.depth[order], np.arange(self.depth.max() + 2))
+        return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    @property
+    def n_nodes(self):
+        return len(self.parent)
+
+    @property
+    def leaf_names(self):
+        """ Names of leaves in tree order
+        """
+        return pd.Index(self.names[self.leaf_order])
+
+    @classmethod
+    def from_biophylo(cls, tree):
+        """ Convert from a Bio.Phylo tree
+
+        Parameters
+        ----------
+        tree : Bio.Phylo.BaseTree.Tree
+            phylogenetic tree
+
+        Returns
+        -------
+        ArrayTree
+            array backed tree
+        """
+        parent = []
+        branch_length = []
+        names = []
+
+        stack = [(tree.root, -1)]
+        while stack:
+            clade, parent_idx = stack.pop()
+            idx = len(parent)
+            parent.append(parent_idx)
+            branch_length.append(np.nan if clade.branch_length is None else clade.branch_length)
+            names.append(clade.name)
+            stack.extend((child, idx) for child in reversed(clade.clades))
+
+        return cls(parent, branch_length, names)
+
+    def to_biophylo(self):
+        """ Convert to a Bio.Phylo tree
+
+        Returns
+        -------
+        Bio.Phylo.BaseTree.Tree
+            phylogenetic tree
+        """
+        clades = []
+        for idx in range(self.n_nodes):
+            branch_length = None if np.isnan(self.branch_length[idx]) else float(self.branch_length[idx])
+            clade = Bio.Phylo.BaseTree.Clade(branch_length=branch_length, name=self.names[idx])
+            if idx > 0:
+                clades[self.parent[idx]].clades.append(clade)
+            clades.append(clade)
+
+        return Bio.Phylo.BaseTree.Tree(root=clades[0], rooted=True)
+
+    @classmethod
+    def from_newick(cls, newick):
+        """ Read from a newick file or string
+
+        Parameters
+        ----------
+        newick : str or file
+            newick filename, file handle or newick string
+
+        Returns
+        -------
+        ArrayTree
+            array backed tree
+        """
+        if isinstance(newick, str) and newick.strip().endswith(';'):
+            newick = io.StringIO(newick)
+        return cls.from_biophylo(Bio.Phylo.read(newick, 'newick'))
+
+    def to_newick(self, filename=None):
+        """ Write to a newick file or string
+
+        Parameters
+        ----------
+        filename : str or file, optional
+            newick filename or file handle, by default None, return a string
+
+        Returns
+        -------
+        str
+            newick string if filename is None
+        """
+        if filename is None:
+            handle = io.StringIO()
+            Bio.Phylo.write(self.to_biophylo(), handle, 'newick')
+            return handle.getvalue().strip()
+        Bio.Phylo.write(self.to_biophylo(), filename, 'newick')
+
+    def get_phylo_order(self, cell_ids):
+        """ Position of each cell in the leaf order, -1 for cells not in the tree
+
+        Parameters
+        ----------
+        cell_ids : list
+            cell ids, for instance adata.obs.index
+
+        Returns
+        -------
+        ndarray
+            position of each cell in the leaf order
+        """
+        return self.leaf_names.get_indexer(cell_ids)
+
+    def clade_leaves(self, node):
+        """ Names of the leaves of a clade
+
+        Parameters
+        ----------
+        node : int
+            node index of the clade
+
+        Returns
+        -------
+        Index
+            leaf names in tree order
+        """
+        start = self.leaf_start[node]
+        return self.leaf_names[start:start + self.clade_size[node]]
+
+    def prune(self, keep):
+        """ Prune leaves, collapsing clades left with one child
+
+        Clades with more than one child left with a single child are collapsed
+        into the child, adding their branch length, as in `prune_leaves`.
+        Clades left without leaves are removed.
+
+        Parameters
+        ----------
+        keep : ndarray or list
+            boolean mask of leaves to keep in tree order, or names of leaves to keep
+
+        Returns
+        -------
+        ArrayTree
+            pruned tree
+        """
+        keep = np.asarray(keep)
+        if keep.dtype != bool:
+            keep = self.leaf_names.isin(keep)
+
+        is_kept_leaf = np.zeros(self.n_nodes, dtype=bool)
+        is_kept_leaf[self.leaf_order[keep]] = True
+
+        # Number of kept leaves of each clade
+        kept_leaves = np.cumsum(np.concatenate([[0], is_kept_leaf[self.leaf_order]]))
+        n_kept = kept_leaves[self.leaf_start + self.clade_size] - kept_leaves[self.leaf_start]
+        is_present = n_kept > 0
+
+        if not is_present.any():
+            raise ValueError('cannot prune all leaves')
+
+        kept_children = np.bincount(self.parent[1:][is_present[1:]], minlength=self.n_nodes)
+        is_collapsed = is_present & (self.n_children >= 2) & (kept_children == 1)
+        is_retained = is_present & ~is_collapsed
+
+        # Branch lengths of collapsed ancestors are added to their retained descendants
+        collapsed_length = _ancestor_sum(self.parent, np.where(is_collapsed, np.nan_to_num(self.branch_length), 0.))
+        collapsed_length = np.concatenate([[0.], collapsed_length])
+        retained_ancestor = _nearest_ancestor(self.parent, is_retained)
+        added_length = collapsed_length[self.parent + 1] - collapsed_length[retained_ancestor + 1]
+
+        retained = np.flatnonzero(is_retained)
+        new_index = np.full(self.n_nodes, -1)
+        new_index[retained] = np.arange(len(retained))
+
+        parent = retained_ancestor[retained]
+        parent = np.where(parent >= 0, new_index[np.maximum(parent, 0)], -1)
+        branch_length = self.branch_length[retained] + added_length[retained]
+
+        return ArrayTree(parent, branch_length, self.names[retained])
+
+    def aggregate_leaves(self, values, func='sum'):
+        """ Aggregate values of leaves for every clade
+
+        Parameters
+        ----------
+        values : ndarray
+            values for each leaf in tree order, with leaves along the first axis
+        func : str, optional
+            'sum' or 'mean', by default 'sum'
+
+        Returns
+        -------
+        ndarray
+            aggregated values for each node
+        """
+        values = np.asarray(values, dtype=float)
+        cumulative = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+        sums = cumulative[self.leaf_start + self.clade_size] - cumulative[self.leaf_start]
+
+        if func == 'sum':
+            return sums
+        elif func == 'mean':
+            return sums / self.clade_size.reshape((-1,) + (1,) * (values.ndim - 1))
+        else:
+            raise ValueError(f'unknown func {func}')
+
+    def coordinates(self):
+        """ Drawing coordinates of each node
+
+        Leaves are placed at their position in the leaf order, and clades at
+        the midpoint of their first and last child, as in `Bio.Phylo.draw`.
+
+        Returns
+        -------
+        tuple
+            x, distance from the root, and y coordinates of each node
+        """
+        branch_length = self.branch_length
+        if np.isnan(branch_length[1:]).all():
+            branch_length = np.ones(self.n_nodes)
+        branch_length = np.nan_to_num(branch_length)
+        branch_length[0] = 0.
+        x = _ancestor_sum(self.parent, branch_length)
+
+        last_child = np.full(self.n_nodes, -1)
+        np.maximum.at(last_child, self.parent[1:], np.arange(1, self.n_nodes))
+
+        y = np.zeros(self.n_nodes)
+        y[self.leaf_order] = np.arange(len(self.leaf_order))
+        for nodes in self._levels()[::-1]:
+            internal = nodes[~self.is_leaf[nodes]]
+            y[internal] = (y[internal + 1] + y[last_child[internal]]) / 2
+
+        return x, y
+
+    def segments(self, min_clade_size=None):
+        """ Line segments for drawing the tree
+
+        Parameters
+        ----------
+        min_clade_size : int, optional
+            clades with fewer leaves are collapsed and drawn as a single line
+            to their furthest leaf, by default None, no collapsing
+
+        Returns
+        -------
+        ndarray
+            segments of shape (n, 2, 2), horizontal branches for each non root
+            node followed by vertical lines spanning the children of each clade
+        """
+        x, y = self.coordinates()
+
+        is_collapsed = np.zeros(self.n_nodes, dtype=bool)
+        if min_clade_size is not None:
+            is_collapsed = self.clade_size < min_clade_size
+            is_collapsed[0] = False
+
+            # Extend collapsed clades to their furthest leaf, clade size
+            # decreases from the root so descendants are also collapsed
+            is_top = is_collapsed.copy()
+            is_top[1:] &= ~is_collapsed[self.parent[1:]]
+            top = np.where(is_top, np.arange(self.n_nodes), _nearest_ancestor(self.parent, is_top))
+            leaves = self.leaf_order[is_collapsed[self.leaf_order]]
+            np.maximum.at(x, top[leaves], x[leaves])
+
+        nodes = np.arange(1, self.n_nodes)
+        nodes = nodes[~is_collapsed[self.parent[nodes]]]
+        horizontal = np.stack([
+            np.stack([x[self.parent[nodes]], y[nodes]], axis=1),
+            np.stack([x[nodes], y[nodes]], axis=1),
+        ], axis=1)
+
+        last_child = np.full(self.n_nodes, -1)
+        np.maximum.at(last_child, self.parent[1:], np.arange(1, self.n_nodes))
+        internal = np.flatnonzero(~self.is_leaf & ~is_collapsed)
+        vertical = np.stack([
+            np.stack([x[internal], y[internal + 1]], axis=1),
+            np.stack([x[internal], y[last_child[internal]]], axis=1),
+        ], axis=1)
+
+        return np.concatenate([horizontal, vertical])
+
+
+_clade_agg_functions = ('sum', 'mean', 'median', 'mode')
+
+
+def _clade_sums(tree, values, nodes):
+    """ Sums of leaf values in tree order for the given clades.
+    """
+    cumulative = np.zeros((values.shape[0] + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=cumulative[1:])
+    start = tree.leaf_start[nodes]
+    return cumulative[start + tree.clade_size[nodes]] - cumulative[start]
+
+
+def _column_modes(X):
+    """ Most frequent non nan value of each column, the smallest if tied, nan if none.
+    """
+    values = np.sort(X.T, axis=1)
+    n_columns, n_rows = values.shape
+    values = values.ravel()
+
+    # Runs of equal values within each column, nan values are runs of length 1
+    is_start = np.ones(values.shape, dtype=bool)
+    is_start[1:] = values[1:] != values[:-1]
+    is_start[::n_rows] = True
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, values.shape[0]))
+    columns = starts // n_rows
+
+    is_valid = ~np.isnan(values[starts])
+    starts, lengths, columns = starts[is_valid], lengths[is_valid], columns[is_valid]
+
+    # Longest run of each column, runs of the same length ordered by value
+    order = np.lexsort((-lengths, columns))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = columns[order][1:] != columns[order][:-1]
+    first = order[is_first]
+
+    modes = np.full(n_columns, np.nan)
+    modes[columns[first]] = values[starts[first]]
+    return modes
+
+
+def _aggregate_clade_chunk(tree, X, agg_f, nodes):
+    """ Aggregate a chunk of bins for the given clades, ignoring nan.
+    """
+    is_present = ~np.isnan(X)
+    n_present = _clade_sums(tree, is_present, nodes)
+
+    if agg_f in ('sum', 'mean'):
+        sums = _clade_sums(tree, np.where(is_present, X, 0.), nodes)
+        if agg_f == 'sum':
+            return sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / n_present
+
+    states = np.unique(X[is_present])
+    if not np.array_equal(states, np.round(states)):
+        raise ValueError(f'{agg_f} aggregation requires integer states')
+
+    result = np.full(n_present.shape, np.nan)
+    if len(states) == 0:
+        return result
+
+    # Sort the cells of each clade if counting each state would scan more values
+    if len(states) * X.shape[0] > tree.clade_size[nodes].sum():
+        for idx, node in enumerate(nodes):
+            X_clade = X[tree.leaf_start[node]:tree.leaf_start[node] + tree.clade_size[node]]
+            if agg_f == 'median':
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', category=RuntimeWarning)
+                    result[idx] = np.nanmedian(X_clade, axis=0)
+            else:
+                result[idx] = _column_modes(X_clade)
+        return result
+
+    # Rank of the lower and upper middle values, median is their mean
+    lower_rank = np.floor((n_present - 1) / 2)
+    upper_rank = np.floor(n_present / 2)
+    lower = np.full(n_present.shape, np.nan)
+    upper = np.full(n_present.shape, np.nan)
+
+    max_count = np.zeros(n_present.shape)
+    cumulative_count = np.zeros(n_present.shape)
+
+    for state in states:
+        count = _clade_sums(tree, X == state, nodes)
+
+        if agg_f == 'median':
+            cumulative_count += count
+            lower[np.isnan(lower) & (cumulative_count > lower_rank)] = state
+            upper[np.isnan(upper) & (cumulative_count > upper_rank)] = state
+
+        else:
+            is_mode = count > max_count
+            max_count[is_mode] = count[is_mode]
+            result[is_mode] = state
+
+    if agg_f == 'median':
+        result = (lower + upper) / 2
+
+    return result
+
+
+def _aggregate_clade_layer(tree, X, agg_f, nodes, rows=None, max_chunk_elements=10000000):
+    """ Aggregate a cells by bins matrix in chunks of bins for the given clades,
+    gathering the given rows in tree order one chunk at a time.
+    """
+    if agg_f not in _clade_agg_functions:
+        raise ValueError(f'unknown aggregate function {agg_f}, expected one of {_clade_agg_functions}')
+
+    result = np.empty((len(nodes), X.shape[1]))
+
+    chunk_size = max(1, max_chunk_elements // max(1, X.shape[0]))
+    for start in range(0, X.shape[1], chunk_size):
+        if rows is None:
+            X_chunk = X[:, start:start+chunk_size]
+        else:
+            X_chunk = X[rows, start:start+chunk_size]
+        if scipy.sparse.issparse(X_chunk):
+            X_chunk = X_chunk.toarray()
+        X_chunk = np.asarray(X_chunk, dtype=float)
+        result[:, start:start+chunk_size] = _aggregate_clade_chunk(tree, X_chunk, agg_f, nodes)
+
+    return result
+
+
+def aggregate_clades(
+        tree,
+        adata: AnnData,
+        agg_X: str=None,
+        agg_layers: Dict=None,
+        clade_size_col: str='clade_size',
+        include_leaves: bool=False,
+        dtype_policy=None,
+        max_chunk_elements: int=10000000) -> AnnData:
+    """ Aggregate copy number by clade to create a clade CN matrix
+
+    Aggregates for all clades are computed together from cumulative sums
+    over the cells in tree order, in which each clade is a contiguous range of
+    cells, rather than by scanning the cells of each clade.  Medians and modes
+    are computed from per clade counts of each integer state, or by sorting
+    the cells of each clade for layers with many distinct values such as read
+    counts.  Missing values are ignored.
+
+    Parameters
+    ----------
+    tree : Bio.Phylo.BaseTree.Tree or ArrayTree
+        phylogenetic tree with leaves named by cell id, see `align_cn_tree`
+    adata : AnnData
+        copy number data for the cells of the tree
+    agg_X : str, optional
+        aggregation of X, one of 'sum', 'mean', 'median', 'mode', by default None
+    agg_layers : Dict, optional
+        aggregation of layers keyed by layer names, one of 'sum', 'mean', 'median', 'mode', by default None
+    clade_size_col : str, optional
+        column that will be set to the number of cells of each clade, by default 'clade_size'
+    include_leaves : bool, optional
+        include clades for individual cells, by default False
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
+    max_chunk_elements : int, optional
+        maximum number of values of each layer aggregated at a time, by default 10000000
+
+    Returns
+    -------
+    AnnData
+        aggregated clade copy number, with obs of the node index, depth and
+        parent clade of each clade
+
+    Examples
+    -------
+
+    >>> tree, adata = scgenome.tl.align_cn_tree(tree, adata)
+    >>> clade_adata = scgenome.tl.aggregate_clades(tree, adata, agg_layers={'copy': 'mean', 'state': 'median'})
+
+    """
+    if not isinstance(tree, ArrayTree):
+        tree = ArrayTree.from_biophylo(tree)
+
+    cell_positions = adata.obs.index.get_indexer(tree.leaf_names)
+    if (cell_positions < 0).any() or len(cell_positions) != adata.shape[0]:
+        raise ValueError('tree and adata have different cells, see align_cn_tree')
+
+    nodes = np.arange(tree.n_nodes) if include_leaves else np.flatnonzero(~tree.is_leaf)
+
+    # Cells already in tree order, for instance from align_cn_tree, are not gathered
+    rows = None
+    if not np.array_equal(cell_positions, np.arange(adata.shape[0])):
+        rows = cell_positions
+
+    def __aggregate_layer(layer_name, agg_f):
+        X = adata.layers[layer_name] if layer_name is not None else adata.X
+        if not isinstance(X, np.ndarray) and not scipy.sparse.issparse(X):
+            X = scgenome.tools.getters.get_layer_matrix(adata, layer_name)
+        if scipy.sparse.issparse(X) and rows is not None:
+            return _aggregate_clade_layer(tree, X[rows], agg_f, nodes, max_chunk_elements=max_chunk_elements)
+        return _aggregate_clade_layer(tree, X, agg_f, nodes, rows=rows, max_chunk_elements=max_chunk_elements)
+
+    X = None
+    if agg_X is not None:
+        X = __aggregate_layer(None, agg_X)
+
+    layer_data = None
+    if agg_layers is not None:
+        layer_data = {}
+        for layer_name in agg_layers:
+            layer_data[layer_name] = __aggregate_layer(layer_name, agg_layers[layer_name])
+
+    # Name clades by node name, unique names for unnamed clades
+    names = np.array([
+        name if name is not None else f'clade_{idx}'
+        for idx, name in enumerate(tree.names)], dtype=object)
+    if len(set(names)) != len(names):
+        names = np.array([f'clade_{idx}' for idx in range(tree.n_nodes)], dtype=object)
+
+    obs_data = pd.DataFrame({
+        clade_size_col: tree.clade_size[nodes],
+        'node': nodes,
+        'depth': tree.depth[nodes],
+        'parent_clade': np.where(tree.parent[nodes] >= 0, names[np.maximum(tree.parent[nodes], 0)], ''),
+        'is_leaf': tree.is_leaf[nodes],
+    }, index=pd.Index(names[nodes].astype(str), name='clade_id'))
+
+    adata = ad.AnnData(
+        X,
+        obs=obs_data,
+        var=adata.var,
+        layers=layer_data,
+    )
+
+    adata = scgenome.preprocessing.dtype_policy.apply_dtype_policy(adata, dtype_policy)
+
+    return adata
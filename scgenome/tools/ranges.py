@@ -1,6 +1,8 @@
 import pyranges as pr
 import pandas as pd
 import anndata as ad
+import numpy as np
+import scipy.sparse
 
 from pyranges import PyRanges
 from pandas import DataFrame
@@ -8,7 +10,8 @@ from anndata import AnnData
 from numpy import ndarray
 
 import scgenome.refgenome
-
+import scgenome.preprocessing.dtype_policy
+import scgenome.tools.getters
 
 
 def dataframe_to_pyranges(data: DataFrame) -> PyRanges:
@@ -122,7 +125,18 @@ def rebin_agg_df(data: DataFrame, intersect: DataFrame, agg_f: dict) -> DataFram
     return data
 
 
-def rebin_agg_layer(adata: AnnData, intersect: DataFrame, layer_name: str, agg_f: dict) -> DataFrame:
+def _rebin_agg_df_cells(data: DataFrame, intersect: DataFrame, agg_f: dict) -> DataFrame:
+    data = data.loc[:, intersect['bin']].T
+
+    data = data.set_index(intersect.set_index('bin')['target_bin'], append=True)
+    data = data.set_index(intersect.set_index('bin')['width'], append=True)
+
+    data = data.groupby(level='target_bin').agg(agg_f)
+
+    return data.T
+
+
+def rebin_agg_layer(adata: AnnData, intersect: DataFrame, layer_name: str, agg_f: dict, chunk_size: int=None) -> DataFrame:
     """ Rebin an anndata layer, aggregating across multiple intersecting regions
 
     Parameters
@@ -135,22 +149,48 @@ def rebin_agg_layer(adata: AnnData, intersect: DataFrame, layer_name: str, agg_f
         name of layer to rebin and aggregate
     agg_f : dict of tuples
         aggregate functions, similar to pandas dataframe groupby .agg
+    chunk_size : int, optional
+        number of cells to aggregate at a time, by default None, all cells
+        at once unless the layer is sparse or adata is backed
 
     Returns
     -------
     DataFrame
-        rebinned and aggregated layer data with columns according to 'agg_f' and index 'target_bin'
+        rebinned and aggregated layer data with columns according to 'agg_f' and index 'target_bin',
+        sparse if the layer is sparse
     """
-    data = adata.to_df(layer=layer_name)
+    if layer_name is not None:
+        layer_data = adata.layers[layer_name]
+    else:
+        layer_data = adata.X
 
-    data = data.loc[:, intersect['bin']].T
+    if chunk_size is None and (scipy.sparse.issparse(layer_data) or adata.isbacked):
+        chunk_size = scgenome.tools.getters.default_chunk_size
 
-    data = data.set_index(intersect.set_index('bin')['target_bin'], append=True)
-    data = data.set_index(intersect.set_index('bin')['width'], append=True)
+    if chunk_size is None:
+        data = adata.to_df(layer=layer_name)
+        return _rebin_agg_df_cells(data, intersect, agg_f)
 
-    data = data.groupby(level='target_bin').agg(agg_f)
-    
-    return data.T
+    # Aggregate functions are arbitrary, densify chunks of cells
+    blocks = []
+    is_sparse = False
+    for cells, chunk in scgenome.tools.getters.iter_layer_chunks(adata, layer_name, chunk_size=chunk_size):
+        if scipy.sparse.issparse(chunk):
+            is_sparse = True
+            chunk = chunk.toarray()
+        chunk = pd.DataFrame(chunk, index=adata.obs.index[cells], columns=adata.var.index)
+        chunk = _rebin_agg_df_cells(chunk, intersect, agg_f)
+        if is_sparse:
+            chunk = scipy.sparse.csr_matrix(chunk.values), chunk.columns
+        blocks.append(chunk)
+
+    if not is_sparse:
+        return pd.concat(blocks)
+
+    columns = blocks[0][1]
+    data = scipy.sparse.vstack([b[0] for b in blocks], format='csr')
+
+    return pd.DataFrame.sparse.from_spmatrix(data, index=adata.obs.index, columns=columns)
 
 
 def intersect_regions(a: DataFrame, b: DataFrame) -> DataFrame:
@@ -182,7 +222,31 @@ def intersect_regions(a: DataFrame, b: DataFrame) -> DataFrame:
     return intersect
 
 
-def rebin(adata: AnnData, target_bins: DataFrame, outer_join: bool=False, agg_X=None, agg_var=None, agg_layers=()) -> AnnData:
+def _reindex_bins(data: DataFrame, bins):
+    """ Reindex rebinned data to target bins, sparse data is returned as a
+    sparse matrix with explicit nan for missing bins
+    """
+    if not hasattr(data, 'sparse'):
+        return data.reindex(columns=bins)
+
+    matrix = scipy.sparse.csc_matrix(data.sparse.to_coo())
+    indexer = data.columns.get_indexer(bins)
+    missing = np.where(indexer < 0)[0]
+
+    matrix = matrix[:, np.where(indexer < 0, 0, indexer)]
+
+    if len(missing) > 0:
+        is_missing = np.zeros(len(bins), dtype=bool)
+        is_missing[missing] = True
+        matrix = matrix @ scipy.sparse.diags((~is_missing).astype(matrix.dtype))
+        rows, cols = np.meshgrid(np.arange(matrix.shape[0]), missing, indexing='ij')
+        matrix = matrix + scipy.sparse.csc_matrix(
+            (np.full(rows.size, np.nan), (rows.ravel(), cols.ravel())), shape=matrix.shape)
+
+    return scipy.sparse.csr_matrix(matrix)
+
+
+def rebin(adata: AnnData, target_bins: DataFrame, outer_join: bool=False, agg_X=None, agg_var=None, agg_layers=(), dtype_policy=None, chunk_size=None) -> AnnData:
     """ Rebin an AnnData and aggregate across multiple intersecting regions
 
     Parameters
@@ -199,6 +263,11 @@ def rebin(adata: AnnData, target_bins: DataFrame, outer_join: bool=False, agg_X=
         aggregate functions for var, by default None
     agg_layers : dict, optional
         aggregate functions for each layer, by default ()
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
+    chunk_size : int, optional
+        number of cells to aggregate at a time, by default None, all cells at once
+        unless layers are sparse or adata is backed
 
     Returns
     -------
@@ -229,29 +298,31 @@ def rebin(adata: AnnData, target_bins: DataFrame, outer_join: bool=False, agg_X=
     var = var.sort_values(['chr', 'start'])
 
     if agg_X is not None:
-        X = rebin_agg_layer(adata, intersect, None, agg_X)
-        X = X.reindex(columns=var.index)
+        X = rebin_agg_layer(adata, intersect, None, agg_X, chunk_size=chunk_size)
+        X = _reindex_bins(X, var.index)
 
     else:
         X = None
 
     layer_data = {}
     for layer_name in agg_layers:
-        layer_data[layer_name] = rebin_agg_layer(adata, intersect, layer_name, agg_layers[layer_name])
-        layer_data[layer_name] = layer_data[layer_name].reindex(columns=var.index)
+        layer_data[layer_name] = rebin_agg_layer(adata, intersect, layer_name, agg_layers[layer_name], chunk_size=chunk_size)
+        layer_data[layer_name] = _reindex_bins(layer_data[layer_name], var.index)
 
     adata = ad.AnnData(
         X,
-        dtype=X.values.dtype,
+        dtype=X.dtype if scipy.sparse.issparse(X) else X.values.dtype,
         obs=adata.obs,
         var=var,
         layers=layer_data,
     )
 
+    adata = scgenome.preprocessing.dtype_policy.apply_dtype_policy(adata, dtype_policy)
+
     return adata
 
 
-def rebin_regular(adata: AnnData, bin_size: int, outer_join: bool=False, agg_X=None, agg_var=None, agg_layers=()) -> AnnData:
+def rebin_regular(adata: AnnData, bin_size: int, outer_join: bool=False, agg_X=None, agg_var=None, agg_layers=(), dtype_policy=None, chunk_size=None) -> AnnData:
     """ Rebin an AnnData and aggregate across multiple intersecting regions
 
     Parameters
@@ -268,6 +339,11 @@ def rebin_regular(adata: AnnData, bin_size: int, outer_join: bool=False, agg_X=N
         aggregate functions for var, by default None
     agg_layers : dict, optional
         aggregate functions for each layer, by default ()
+    dtype_policy : str or dict, optional
+        dtypes of X and layers, see `scgenome.pp.apply_dtype_policy`, by default None, no conversion
+    chunk_size : int, optional
+        number of cells to aggregate at a time, by default None, all cells at once
+        unless layers are sparse or adata is backed
 
     Returns
     -------
@@ -277,7 +353,7 @@ def rebin_regular(adata: AnnData, bin_size: int, outer_join: bool=False, agg_X=N
     target_bins = create_bins(bin_size)
     target_bins['start'] = target_bins['start'] + 1
 
-    return rebin(adata, target_bins, outer_join=outer_join, agg_X=agg_X, agg_var=agg_var, agg_layers=agg_layers)
+    return rebin(adata, target_bins, outer_join=outer_join, agg_X=agg_X, agg_var=agg_var, agg_layers=agg_layers, dtype_policy=dtype_policy, chunk_size=chunk_size)
 
 
 def weighted_mean(values: ndarray, widths: ndarray) -> float:
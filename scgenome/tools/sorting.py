@@ -1,6 +1,8 @@
 import numpy as np
 import scipy.cluster.hierarchy as sch
 import scipy.spatial.distance as dst
+import scipy.sparse
+import sklearn.metrics
 import sklearn.preprocessing
 import pandas as pd
 
@@ -9,6 +11,7 @@ from collections.abc import Iterable
 from typing import Union, Any, Dict
 
 import scgenome.preprocessing.transform
+import scgenome.tools.getters
 
 
 def sort_cells(
@@ -17,6 +20,7 @@ def sort_cells(
         cell_ids: Iterable[str]=None,
         bin_ids: Iterable[str]=None,
         standarize: bool=False,
+        use_rep: str=None,
     ) -> AnnData:
     """ Sort cells by hierarchical clustering on copy number values.
 
@@ -32,6 +36,8 @@ def sort_cells(
         subset of bins to cluster, by default None
     standarize : bool
         standardize the data prior to sorting, by default False
+    use_rep : str, optional
+        sort on a cell embedding in obsm such as 'X_pca' instead of layers, by default None
 
     Returns
     -------
@@ -44,25 +50,14 @@ def sort_cells(
     if bin_ids is None:
         bin_ids = adata.var.index
 
-    def __get_layer(layer_name):
-        if layer_name is not None:
-            return np.array(adata[cell_ids, bin_ids].layers[layer_name])
-        else:
-            return np.array(adata[cell_ids, bin_ids].X)
+    # Sparse data is scaled but not centered, centering does not affect cityblock distances
+    X = scgenome.tools.getters.get_feature_matrix(
+        adata, layer_name, cell_ids=cell_ids, bin_ids=bin_ids, standardize=standarize, use_rep=use_rep)
 
-    if isinstance(layer_name, (str, type(None))):
-        X = __get_layer(layer_name)
-    elif isinstance(layer_name, Iterable):
-        X = np.concatenate([__get_layer(l) for l in layer_name], axis=1)
+    if scipy.sparse.issparse(X):
+        D = sklearn.metrics.pairwise_distances(X, metric='cityblock')
     else:
-        raise ValueError(f'layer_name was {layer_name}')
-
-    X = scgenome.preprocessing.transform.fill_missing(X)
-
-    if standarize:
-        X = sklearn.preprocessing.StandardScaler().fit_transform(X)
-
-    D = dst.squareform(dst.pdist(X, 'cityblock'))
+        D = dst.squareform(dst.pdist(X, 'cityblock'))
     Y = sch.linkage(D, method='complete')
     Z = sch.dendrogram(Y, color_threshold=-1, no_plot=True)
     idx = np.array(Z['leaves'])